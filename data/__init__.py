@@ -4,4 +4,5 @@ from data.prompts import (
     COMPLETIONS_PROMPT_OPENAI_NO_INFO,
     COMPLETIONS_PROMPT_OPENAI_SYSTEM,
     EMBEDDING_INSTRUCTION,
+    SUMMARIZATION_PROMPT,
 )
@@ -42,3 +42,7 @@ Text:
 
 Question: {query}"""
 )
+
+SUMMARIZATION_PROMPT = (
+    lambda text: f"Can you provide a comprehensive summary of the given article from a knowledge base? The summary should cover all the key points and main ideas presented in the original text, while also condensing the information into a concise and easy-to-understand format. Please ensure that the summary includes relevant details and examples that support the main ideas, while avoiding any unnecessary information or repetition. The length of the summary should be appropriate for the length and complexity of the original text, providing a clear and accurate overview without omitting any important information.\n\nText:\n\"\"\"\n{text}\n\"\"\""
+)
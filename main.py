@@ -1,30 +1,43 @@
-import os.path as osp
-import threading
+import asyncio
 import time
 from pprint import pformat
-from tempfile import TemporaryDirectory
 from typing import List
 
 import openai
 import uvicorn
-from async_lru import alru_cache
-from fastapi import FastAPI, File, HTTPException, UploadFile, status
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, File, Form, HTTPException, Query, Request, UploadFile, status
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from loguru import logger
-from torch import multiprocessing
 
 from data import EMBEDDING_INSTRUCTION
-from ml import EmbeddingModel
-from ml.completions import AlpacaCompletionModel, CompletionModel, OpenAICompletionModel, T5CompletionModel
+from ml import AnswerInContextFilter, OpenAIEmbeddingModel, OpenAITranscriptionModel
+from ml.completions import OpenAICompletionModel, race_completions
+from ml.model_server import (
+    RemoteCompletionModel,
+    RemoteEmbeddingModel,
+    connect_model_server,
+    start_model_server,
+    stop_model_server,
+)
 from utils import CONFIG
-from utils.api import catch_errors
+from utils.api import catch_errors, embeddings_response
+from utils.batch import read_jsonl, run_batch
+from utils.cache import CompletionCache, EmbeddingCache, MemoryCache, SqliteCache
 from utils.gunicorn_logging import run_gunicorn_loguru
-from utils.misc import retry_with_time_limit
+from utils.http import UPSTREAM_SESSION, SharedSessionMiddleware
+from utils.metrics import MetricsMiddleware, mark_worker_dead, metrics_response, reset_metrics
+from utils.retry import UPSTREAMS
 from utils.schemas import (
+    AnswerFilterStatsResponse,
     AnswerInContextResponse,
     ApiVersion,
+    BatchTask,
+    CacheStatsResponse,
+    CompletionsBatchInput,
+    CompletionsBatchResult,
     CompletionsInput,
     CompletionsResponse,
+    EmbeddingsBase64Response,
     EmbeddingsInput,
     EmbeddingsInputInstruction,
     EmbeddingsResponse,
@@ -32,28 +45,109 @@ from utils.schemas import (
     SpeechToTextResponse,
     SummarizationInput,
 )
+from utils.sse import sse_response
+from utils.startup import StartupReport
 
 app = FastAPI()
+app.add_middleware(SharedSessionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event("startup")
 def init_globals():
-    global manager, multiprocessing_context_fork, multiprocessing_context_forkserver
-    manager = multiprocessing.Manager()
-    multiprocessing_context_fork = multiprocessing.get_context("fork")
-    multiprocessing_context_forkserver = multiprocessing.get_context("forkserver")
-
-    global embedding_model, alpaca_completion_model, openai_completion_model
-    openai_completion_model = OpenAICompletionModel(
-        model_name=CONFIG["v1.completions"]["model"],
+    global embedding_model, alpaca_completion_model, openai_completion_model, openai_embedding_model
+    global answer_filter, openai_transcription_model
+    startup = StartupReport()
+    UPSTREAM_SESSION.open(
+        pool_size=int(CONFIG["http"]["pool_size"]),
+        pool_size_per_host=int(CONFIG["http"]["pool_size_per_host"]),
+        dns_ttl=int(CONFIG["http"]["dns_ttl"]),
+        keepalive_timeout=float(CONFIG["http"]["keepalive_timeout"]),
+    )
+    with startup.step("openai embeddings"):
+        embedding_cache = None
+        if CONFIG["cache.embeddings"].getboolean("enabled"):
+            embedding_cache = EmbeddingCache(
+                path=CONFIG["cache.embeddings"]["path"],
+                max_bytes=int(CONFIG["cache.embeddings"]["max_bytes"]),
+                ttl=int(CONFIG["cache.embeddings"]["ttl"]),
+            )
+        openai_embedding_model = OpenAIEmbeddingModel(
+            model_name=CONFIG["v1.embeddings"]["model"],
+            cache=embedding_cache,
+            batch_window=int(CONFIG["v1.embeddings"]["batch_window_ms"]) / 1000,
+            batch_max_size=int(CONFIG["v1.embeddings"]["batch_max_size"]),
+            batch_max_tokens=int(CONFIG["v1.embeddings"]["batch_max_tokens"]),
+            max_request_size=int(CONFIG["v1.embeddings"]["max_request_size"]),
+            max_request_tokens=int(CONFIG["v1.embeddings"]["max_request_tokens"]),
+            concurrency=int(CONFIG["v1.embeddings"]["concurrency"]),
+            request_timeout=float(CONFIG["v1.embeddings"]["request_timeout"]),
+            max_retries=int(CONFIG["v1.embeddings"]["max_retries"]),
+            repair_rounds=int(CONFIG["v1.embeddings"]["repair_rounds"]),
+        )
+    with startup.step("openai completions"):
+        completion_cache = None
+        if CONFIG["cache.completions"].getboolean("enabled"):
+            completion_cache = CompletionCache(
+                SqliteCache(
+                    path=CONFIG["cache.completions"]["path"],
+                    max_bytes=int(CONFIG["cache.completions"]["max_bytes"]),
+                    ttl=int(CONFIG["cache.completions"]["ttl"]),
+                )
+                if CONFIG["cache.completions"]["backend"] == "sqlite"
+                else MemoryCache(
+                    max_bytes=int(CONFIG["cache.completions"]["max_bytes"]),
+                    ttl=int(CONFIG["cache.completions"]["ttl"]),
+                )
+            )
+        openai_completion_model = OpenAICompletionModel(
+            model_name=CONFIG["v1.completions"]["model"],
+            cache=completion_cache,
+        )
+    openai_transcription_model = OpenAITranscriptionModel(
+        model_name=CONFIG["transcription"]["model"],
+        concurrency=int(CONFIG["transcription"]["concurrency"]),
+        time_limit=float(CONFIG["transcription"]["time_limit"]),
+        direct_max_bytes=int(CONFIG["transcription"]["direct_max_bytes"]),
+        max_segment_ms=int(CONFIG["transcription"]["max_segment_s"]) * 1000,
+        min_silence_ms=int(CONFIG["transcription"]["min_silence_ms"]),
+        silence_offset_db=float(CONFIG["transcription"]["silence_offset_db"]),
+        bitrate=CONFIG["transcription"]["bitrate"],
     )
-    # alpaca_completion_model = AlpacaCompletionModel(
-    #     model_name=CONFIG["v2.completions"]["model"],
-    #     device=CONFIG["v2.completions"]["device"],
-    # )
-    # embedding_model = EmbeddingModel(
-    #     model_name=CONFIG["v2.embeddings"]["model"], device=CONFIG["v2.embeddings"]["device"]
-    # )
+    embedding_model, alpaca_completion_model = None, None
+    if CONFIG["model_server"].getboolean("enabled"):
+        # local models live in a single model server process shared by all workers
+        with startup.step("model server"):
+            model_server = connect_model_server()
+        models = CONFIG["model_server"]["models"].split(",")
+        if "embeddings" in models:
+            embedding_model = RemoteEmbeddingModel(model_server)
+        if "alpaca" in models:
+            alpaca_completion_model = RemoteCompletionModel(model_server)
+    if CONFIG["v4.completions"].getboolean("enabled") and alpaca_completion_model is None:
+        # the local side of the v3 race is shared by all workers instead of being loaded by each of them
+        raise ValueError("v4.completions needs the model server with the alpaca model")
+    answer_filter = None
+    if CONFIG["answer_filter"].getboolean("enabled"):
+        if CONFIG["answer_filter"]["embeddings"] == "local" and embedding_model is None:
+            raise ValueError("answer_filter.embeddings=local needs the model server with the embeddings model")
+        embed = {
+            "openai": openai_embedding_model.get_embeddings,
+            "local": lambda input: embedding_model.get_embeddings(input, instruction=EMBEDDING_INSTRUCTION),
+        }.get(CONFIG["answer_filter"]["embeddings"])
+        answer_filter = AnswerInContextFilter(
+            embed=embed,
+            lexical_high=float(CONFIG["answer_filter"]["lexical_high"]),
+            similarity_low=float(CONFIG["answer_filter"]["similarity_low"]),
+            similarity_high=float(CONFIG["answer_filter"]["similarity_high"]),
+            passage_tokens=int(CONFIG["answer_filter"]["passage_tokens"]),
+        )
+    startup.log()
+
+
+@app.on_event("shutdown")
+async def close_globals():
+    await UPSTREAM_SESSION.close()
 
 
 @app.get("/", include_in_schema=False)
@@ -61,46 +155,68 @@ async def docs_redirect():
     return RedirectResponse(url=f"/docs")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # collecting reads the samples files of all workers
+    content, media_type = await asyncio.to_thread(metrics_response)
+    return Response(content=content, media_type=media_type)
+
+
 @app.post(
     "/{api_version}/embeddings/",
     response_model=EmbeddingsResponse,
-    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/octet-stream": {}},
+            "description": "Base64 or raw buffer if requested, see `encoding_format`.",
+            "model": EmbeddingsBase64Response,
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse},
+    },
 )
 @catch_errors
-@alru_cache(maxsize=512)
-async def get_embeddings(api_version: ApiVersion, embeddings_input: EmbeddingsInput):
+async def get_embeddings(api_version: ApiVersion, embeddings_input: EmbeddingsInput, request: Request):
     logger.info(f"Number of texts to embed: {len(embeddings_input.input)}")
-    args = {
-        "input": embeddings_input.input,
-        "model": CONFIG["v1.embeddings"]["model"],
-    }
-    if len(embeddings_input.input) == 1:
-        embeddings = await retry_with_time_limit(openai.Embedding.acreate, time_limit=2, max_retries=10, **args)
-    else:
-        embeddings = await openai.Embedding.acreate(**args)
-    embeddings_final = []
-    for i, embedding_object in enumerate(embeddings["data"]):
-        embedding = embedding_object["embedding"]
-        while len(embedding) == 1:
-            logger.warning(f"Faced embedding of length 1 on place {i}. Retrying with a single failed chunk...")
-            args["input"] = [embeddings_input.input[i]]
-            embedding = (await retry_with_time_limit(openai.Embedding.acreate, time_limit=2, max_retries=10, **args))[
-                "data"
-            ][0]["embedding"]
-            logger.warning(f"After retrying received embedding of size {len(embedding)}")
-        embeddings_final.append(embedding)
-    return EmbeddingsResponse(data=embeddings_final)
-
-
-# @alru_cache(maxsize=512)
+    if not embeddings_input.input:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No texts to embed")
+    embeddings = await openai_embedding_model.get_embeddings(input=embeddings_input.input)
+    return embeddings_response(embeddings, embeddings_input, request)
+
+
+@app.get(
+    "/{api_version}/embeddings/cache/",
+    response_model=CacheStatsResponse,
+    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+)
+@catch_errors
+async def get_embeddings_cache_stats(api_version: ApiVersion):
+    if not openai_embedding_model.cache:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Embeddings cache is disabled")
+    return CacheStatsResponse(**await asyncio.to_thread(openai_embedding_model.cache.stats))
+
+
 @app.post(
     "/{api_version}/completions/",
     response_model=CompletionsResponse,
     responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
 )
 @catch_errors
-async def get_completions(api_version: ApiVersion, completions_input: CompletionsInput):
-    return await openai_completion_model.get_completion(completions_input=completions_input, api_version=api_version)
+async def get_completions(api_version: ApiVersion, completions_input: CompletionsInput, request: Request):
+    return await openai_completion_model.get_completion(
+        completions_input=completions_input, api_version=api_version, request=request
+    )
+
+
+@app.get(
+    "/{api_version}/completions/cache/",
+    response_model=CacheStatsResponse,
+    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+)
+@catch_errors
+async def get_completions_cache_stats(api_version: ApiVersion):
+    if not openai_completion_model.cache:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Completions cache is disabled")
+    return CacheStatsResponse(**await asyncio.to_thread(openai_completion_model.cache.stats))
 
 
 @app.post(
@@ -109,9 +225,9 @@ async def get_completions(api_version: ApiVersion, completions_input: Completion
     responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
 )
 @catch_errors
-async def get_completions(api_version: ApiVersion, summarization_input: SummarizationInput):
+async def get_completions(api_version: ApiVersion, summarization_input: SummarizationInput, request: Request):
     return await openai_completion_model.get_summarization(
-        summarization_input=summarization_input, api_version=api_version
+        summarization_input=summarization_input, api_version=api_version, request=request
     )
 
 
@@ -122,29 +238,115 @@ async def get_completions(api_version: ApiVersion, summarization_input: Summariz
     responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
 )
 @catch_errors
-async def if_answer_in_context(api_version: ApiVersion, completions_input: CompletionsInput):
+async def if_answer_in_context(
+    api_version: ApiVersion,
+    completions_input: CompletionsInput,
+    threshold: float | None = Query(
+        default=None,
+        ge=0,
+        le=1,
+        description="Minimal scorer confidence. Calls with a threshold skip the local pre-filter, its scores are not on the same scale.",
+    ),
+):
+    return await answer_in_context(completions_input, api_version, threshold)
+
+
+@app.get(
+    "/{api_version}/if_answer_in_context/stats/",
+    response_model=AnswerFilterStatsResponse,
+    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+)
+@catch_errors
+async def get_answer_filter_stats(api_version: ApiVersion):
+    if not answer_filter:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Answer filter is disabled")
+    return AnswerFilterStatsResponse(**await asyncio.to_thread(answer_filter.stats))
+
+
+async def answer_in_context(
+    completions_input: CompletionsInput, api_version: ApiVersion, threshold: float | None = None
+) -> AnswerInContextResponse:
+    # clear-cut cases are decided locally, only the ambiguous ones cost a chat completion;
+    # a caller's threshold refers to the scorer confidence, so such calls always go to the scorer
+    if answer_filter and threshold is None:
+        answer = await answer_filter.classify(completions_input)
+        if answer is not None:
+            return AnswerInContextResponse(answer=answer)
     return await openai_completion_model.if_answer_in_context(
-        completions_input=completions_input, api_version=api_version
+        completions_input=completions_input, api_version=api_version, threshold=threshold
+    )
+
+
+def batch_response(
+    items, task: BatchTask, api_version: ApiVersion, skip: List[int], threshold: float | None = None
+) -> StreamingResponse:
+    async def run(completions_input: CompletionsInput):
+        if task == BatchTask.if_answer_in_context:
+            return await answer_in_context(completions_input, api_version, threshold)
+        return await openai_completion_model.get_completion(
+            completions_input=completions_input.copy(update={"stream": False}), api_version=api_version
+        )
+
+    results = run_batch(
+        items,
+        run,
+        upstream=UPSTREAMS["openai.completions"],
+        concurrency=int(CONFIG["batch"]["concurrency"]),
+        skip=set(skip),
+    )
+    return StreamingResponse(results, media_type="application/x-ndjson")
+
+
+@app.post(
+    "/{api_version}/completions/batch/",
+    response_model=CompletionsBatchResult,
+    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+)
+@catch_errors
+async def get_completions_batch(api_version: ApiVersion, batch_input: CompletionsBatchInput):
+    return batch_response(
+        enumerate(batch_input.inputs), batch_input.task, api_version, batch_input.skip, batch_input.threshold
     )
 
 
+@app.post(
+    "/{api_version}/completions/batch/upload/",
+    response_model=CompletionsBatchResult,
+    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+)
+@catch_errors
+async def get_completions_batch_upload(
+    api_version: ApiVersion,
+    file: UploadFile = File(..., description="JSONL file with one completions input per line."),
+    task: BatchTask = Form(default=BatchTask.completions),
+    skip: List[int] = Query(default=[]),
+    threshold: float | None = Query(
+        default=None,
+        ge=0,
+        le=1,
+        description="Minimal scorer confidence for the if_answer_in_context task. Inputs with a threshold skip the local pre-filter.",
+    ),
+):
+    contents = await file.read()
+    return batch_response(read_jsonl(contents, CompletionsInput), task, api_version, skip, threshold)
+
+
 @app.post(
     "/{api_version}/transcribe/",
     response_model=SpeechToTextResponse,
     responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
 )
 @catch_errors
-async def speech2text(file: UploadFile = File(...)):
-    with TemporaryDirectory() as tmpdir:
-        contents = await file.read()
-        print("Filename", file.filename)
-        with open(osp.join(tmpdir, file.filename), "wb") as f:
-            f.write(contents)
-        audio = open(osp.join(tmpdir, file.filename), "rb")
-        # todo: split audio chunks?
-        args = {"model": "whisper-1", "file": audio}
-        transcription = await retry_with_time_limit(openai.Audio.atranscribe, time_limit=6, max_retries=3, **args)
-    return SpeechToTextResponse(data=transcription["text"])
+async def speech2text(
+    request: Request,
+    file: UploadFile = File(...),
+    stream: bool = Form(default=False, description="Stream segments as server-sent events once transcribed."),
+):
+    # the upload is already spooled by starlette, segments are cut from it without another copy on disk
+    if stream:
+        segments = await openai_transcription_model.prepare(file.file, file.filename)
+        return sse_response(request, openai_transcription_model.stream_transcription(segments))
+    return await openai_transcription_model.transcribe(file.file, file.filename)
 
 
 v2 = FastAPI()
@@ -158,16 +360,25 @@ async def docs_redirect():
 @v2.post(
     "/embeddings/",
     response_model=EmbeddingsResponse,
-    responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/octet-stream": {}},
+            "description": "Base64 or raw buffer if requested, see `encoding_format`.",
+            "model": EmbeddingsBase64Response,
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse},
+    },
 )
 @catch_errors
-async def get_embeddings(embeddings_input: EmbeddingsInputInstruction):
+async def get_embeddings(embeddings_input: EmbeddingsInputInstruction, request: Request):
     logger.info(f"Number of texts to embed: {len(embeddings_input.input)}")
-    embeddings = embedding_model.get_embeddings(
+    if not embeddings_input.input:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No texts to embed")
+    embeddings = await embedding_model.get_embeddings(
         input=embeddings_input.input,
         instruction=embeddings_input.instruction if embeddings_input.instruction else EMBEDDING_INSTRUCTION,
     )
-    return EmbeddingsResponse(data=embeddings)
+    return embeddings_response(embeddings, embeddings_input, request)
 
 
 @v2.post(
@@ -176,8 +387,10 @@ async def get_embeddings(embeddings_input: EmbeddingsInputInstruction):
     responses={status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": HTTPExceptionResponse}},
 )
 @catch_errors
-async def get_completions(completions_input: CompletionsInput):
-    completion = alpaca_completion_model.get_completion(completions_input=completions_input)
+async def get_completions(completions_input: CompletionsInput, request: Request):
+    if completions_input.stream:
+        return sse_response(request, alpaca_completion_model.stream_completion(completions_input))
+    completion = await alpaca_completion_model.get_completion(completions_input=completions_input)
     return CompletionsResponse(data=completion)
 
 
@@ -217,7 +430,10 @@ async def docs_redirect():
 @catch_errors
 async def get_embeddings(embeddings_input: EmbeddingsInput):
     logger.info(f"Number of texts to embed: {len(embeddings_input.input)}")
-    embeddings = openai.Embedding.create(input=embeddings_input.input, model=CONFIG["v1.embeddings"]["model"])["data"]
+    embeddings = await UPSTREAMS["openai.embeddings"].call(
+        openai.Embedding.acreate, input=embeddings_input.input, model=CONFIG["v1.embeddings"]["model"]
+    )
+    embeddings = embeddings["data"]
     embeddings = [embedding["embedding"] for embedding in embeddings]
     return EmbeddingsResponse(data=embeddings)
 
@@ -231,55 +447,47 @@ async def get_embeddings(embeddings_input: EmbeddingsInput):
 async def get_completions(completions_input: CompletionsInput):
     logger.info("Received completions request")
 
-    state = manager.dict()
-    for completion_model, context in zip(
-        [openai_completion_model, alpaca_completion_model],
-        [multiprocessing_context_fork, multiprocessing_context_forkserver],
-    ):
-        job = context.Process(
-            target=CompletionModel.get_completion_subprocess,
-            args=(completion_model, completions_input, state),
-            name=completion_model.__class__.__name__,
+    async def get_openai_completion() -> str:
+        completions_input_sync = completions_input.copy(update={"stream": False})
+        completion = await openai_completion_model.get_completion(
+            completions_input=completions_input_sync, api_version=ApiVersion.v1
         )
-        # job.start takes a lot of time itself
-        # and while we don't want to wait for starting
-        # second job if first one is already finished
-        thread = threading.Thread(target=job.start)
-        thread.start()
-        logger.info(f"Started thread with job {job.name}")
+        return completion.data
 
     start = time.time()
-    while time.time() - start < int(CONFIG["v3.completions"]["general_timeout"]):
-        if openai_completion_model.__class__.__name__ in state or (
-            time.time() - start > int(CONFIG["v3.completions"]["openai_timeout"]) and state
-        ):
-            break
-        time.sleep(0.1)
-
-    logger.info(f"Finished in {round(time.time() - start, 2)} seconds with state {state}")
-
-    if not state:
+    try:
+        completion, backend = await race_completions(
+            preferred=asyncio.create_task(get_openai_completion(), name=openai_completion_model.__class__.__name__),
+            fallback=asyncio.create_task(alpaca_completion_model.get_completion(completions_input), name="alpaca"),
+            preferred_timeout=int(CONFIG["v4.completions"]["openai_timeout"]),
+            general_timeout=int(CONFIG["v4.completions"]["general_timeout"]),
+        )
+    except TimeoutError:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Timeout",
         )
 
-    completion = (
-        state[openai_completion_model.__class__.__name__]
-        if openai_completion_model.__class__.__name__ in state
-        else state[alpaca_completion_model.__class__.__name__]
-    )
-
+    logger.info(f"Finished in {round(time.time() - start, 2)} seconds with {backend}")
     return CompletionsResponse(data=completion)
 
 
 # app.mount("/v3", v3)
 
 
+def on_starting(server):
+    reset_metrics()
+    if CONFIG["model_server"].getboolean("enabled"):
+        start_model_server(server)
+
+
 if __name__ == "__main__":
     options = {
         "bind": CONFIG["app"]["host"] + ':' + CONFIG["app"]["port"],
         "workers": CONFIG["app"]["workers"],
         "timeout": CONFIG["app"]["timeout"],
     }
+    options |= {"on_starting": on_starting, "child_exit": mark_worker_dead}
+    if CONFIG["model_server"].getboolean("enabled"):
+        options |= {"on_exit": stop_model_server}
     run_gunicorn_loguru(app, options)
@@ -1 +1,10 @@
-from ml.embeddings import EmbeddingModel
+from ml.answer_filter import AnswerInContextFilter
+from ml.openai_embedding_model import OpenAIEmbeddingModel
+from ml.openai_transcription_model import OpenAITranscriptionModel
+from ml.registry import BACKENDS, load_backend
+
+
+def __getattr__(name: str):
+    if name == "EmbeddingModel":
+        return load_backend("embeddings")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
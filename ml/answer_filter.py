@@ -0,0 +1,92 @@
+import re
+from collections import Counter
+from typing import Awaitable, Callable, List
+
+import numpy as np
+import tiktoken
+from loguru import logger
+
+from utils.metrics import ANSWER_FILTER_DECISIONS, sample_values
+from utils.schemas import CompletionsInput
+from utils.text import split_text
+
+WORD_RE = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can could do does did for from has have how i if in is it its me my of on or "
+    "our so that the their them there these this to was we what when where which who why will with would you your".split()
+)
+
+
+def terms(text: str) -> set:
+    return {word for word in WORD_RE.findall(text.lower()) if word not in STOPWORDS}
+
+
+class AnswerInContextFilter:
+    """
+    Decides clear-cut `if_answer_in_context` cases locally: first by the share of query terms
+    found in the context, then by the best cosine similarity between the query and context
+    passages. Returns None for the ambiguous band, which is left to the LLM scorer.
+    A low term overlap is not decisive, the query may be phrased differently or in another language.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], Awaitable[np.ndarray]] | None,
+        lexical_high: float,
+        similarity_low: float,
+        similarity_high: float,
+        passage_tokens: int = 256,
+    ):
+        self.embed = embed
+        self.lexical_high = lexical_high
+        self.similarity_low = similarity_low
+        self.similarity_high = similarity_high
+        self.passage_tokens = passage_tokens
+        self.enc = tiktoken.get_encoding("cl100k_base")
+
+    async def classify(self, completions_input: CompletionsInput) -> bool | None:
+        context = "\n\n".join([completions_input.info or ""] + [msg.content for msg in completions_input.chat or []])
+        if not context.strip():
+            return self.decide("lexical", False)
+        query_terms = terms(completions_input.query)
+        if not query_terms:
+            return self.decide("lexical", None)
+
+        score = len(query_terms & terms(context)) / len(query_terms)
+        if score >= self.lexical_high:
+            return self.decide("lexical", True)
+        if self.embed is None:
+            return self.decide("lexical", None)
+
+        passages = split_text(self.enc, context, max_tokens=self.passage_tokens)
+        embeddings = await self.embed([completions_input.query] + passages)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        similarity = float((embeddings[1:] @ embeddings[0]).max())
+        logger.info(f"Answer in context scores: lexical {round(score, 3)}, similarity {round(similarity, 3)}")
+        if similarity >= self.similarity_high:
+            return self.decide("embeddings", True)
+        if similarity <= self.similarity_low:
+            return self.decide("embeddings", False)
+        return self.decide("embeddings", None)
+
+    @staticmethod
+    def decide(tier: str, answer: bool | None) -> bool | None:
+        ANSWER_FILTER_DECISIONS.labels(tier, str(answer).lower() if answer is not None else "escalated").inc()
+        return answer
+
+    @staticmethod
+    def stats() -> dict:
+        # summed over all workers, reads the metric files of every worker
+        decisions = Counter()
+        for labels, value in sample_values("coreml_answer_filter_decisions_total"):
+            key = "escalated" if labels["answer"] == "escalated" else f"{labels['tier']}_{labels['answer']}"
+            decisions[key] += int(value)
+        total = sum(decisions.values())
+        return {
+            "lexical_true": decisions["lexical_true"],
+            "lexical_false": decisions["lexical_false"],
+            "embeddings_true": decisions["embeddings_true"],
+            "embeddings_false": decisions["embeddings_false"],
+            "escalated": decisions["escalated"],
+            "short_circuited": (total - decisions["escalated"]) / total if total else 0.0,
+        }
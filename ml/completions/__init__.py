@@ -1,4 +1,12 @@
-from ml.completions.alpaca_completion_model import AlpacaCompletionModel
 from ml.completions.completion_model import CompletionModel
+from ml.completions.completion_worker import race_completions
 from ml.completions.openai_completion_model import OpenAICompletionModel
-from ml.completions.t5_completion_model import T5CompletionModel
+from ml.registry import load_backend
+
+LOCAL_MODELS = {"AlpacaCompletionModel": "alpaca", "T5CompletionModel": "t5"}
+
+
+def __getattr__(name: str):
+    if name in LOCAL_MODELS:
+        return load_backend(LOCAL_MODELS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,75 +1,87 @@
+from concurrent.futures import Future
+from typing import Callable, Tuple
+
 import torch
 from loguru import logger
-from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer
+from transformers import LlamaForCausalLM, LlamaTokenizer
 
 from ml.completions.completion_model import CompletionModel
+from ml.completions.generation import DTYPES, GenerationEngine, load_weights
+from utils.prompt_logging import PROMPT_LOG
 from utils.schemas import CompletionsInput
 
 
 class AlpacaCompletionModel(CompletionModel):
-    def __init__(self, model_name: str, device: str):
-        logger.info(f"Loading {model_name} model to {device}")
+    def __init__(
+        self,
+        model_name: str,
+        device: str,
+        dtype: str = "float16",
+        threads: int = 0,
+        max_batch_size: int = 8,
+        prefix_cache_size: int = 4,
+    ):
+        logger.info(f"Loading {model_name} model to {device} in {dtype}")
         self.device = torch.device(device)
+        if threads:
+            torch.set_num_threads(threads)
         self.tokenizer = LlamaTokenizer.from_pretrained(model_name)
-        # self.model = LlamaForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(
-        #     self.device
-        # )
-        self.model = LlamaForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16).to(self.device)
-        self.model.eval()
         # self.model = torch.compile(self.model)
-
-        self.generation_config = GenerationConfig(
-            # temperature=0.7,
-            # top_p=0.75,
-            # top_k=40,
+        self.model = load_weights(
+            LlamaForCausalLM.from_pretrained(model_name, torch_dtype=DTYPES[dtype]), dtype, self.device
+        )
+        # concurrent requests share decode steps, so the callers should not serialize them
+        self.concurrency = max_batch_size
+        self.engine = GenerationEngine(
+            self.model,
+            self.tokenizer,
+            self.device,
+            max_batch_size=max_batch_size,
             max_new_tokens=300,
             temperature=0.2,
             top_p=0.75,
             top_k=40,
-            num_beams=1,
-            no_repeat_ngram_size=3,
             repetition_penalty=1.2,
-            encoder_repetition_penalty=1.0,
-            typical_p=1.0,
-            length_penalty=1.2,
-            do_sample=True,
+            prefix_cache_size=prefix_cache_size,
         )
 
     def get_completion(self, completions_input: CompletionsInput) -> str:
-        prompt = AlpacaCompletionModel.generate_prompt(completions_input.query, completions_input.info)
-
-        logger.info("completions request:" + "\n" + prompt)
-
-        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
-
-        with torch.no_grad():
-            outputs = self.model.generate(
-                input_ids=input_ids,
-                generation_config=self.generation_config,
-            )
-
-        answer = self.tokenizer.decode(outputs[0][len(input_ids[0]) :], skip_special_tokens=True).lstrip()
-
-        logger.info("completions result:" + "\n" + answer)
-        return answer
+        return self.submit_completion(completions_input).result()
+
+    def submit_completion(
+        self, completions_input: CompletionsInput, on_token: Callable[[str], None] | None = None
+    ) -> Future:
+        # cancelling the future evicts the sequence from the batch at the next decode step,
+        # `on_token` receives the new text after every step
+        prefix, prompt = AlpacaCompletionModel.prompt_parts(completions_input.query, completions_input.info)
+        future = self.engine.submit(prefix, prompt, on_token=on_token)
+        if PROMPT_LOG.sample():
+            PROMPT_LOG.log("completions request:", prefix + prompt)
+            future.add_done_callback(self.log_result)
+        return future
 
     @staticmethod
     def generate_prompt(instruction: str, input_ctxt: str = None) -> str:
+        return "".join(AlpacaCompletionModel.prompt_parts(instruction, input_ctxt))
+
+    @staticmethod
+    def prompt_parts(instruction: str, input_ctxt: str = None) -> Tuple[str, str]:
+        # the header is the same for every request, its kv cache is computed only once
         if input_ctxt:
             # return f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-            return f"""Below is a question from a customer to an agent, paired with a potentially useful context. Answer customer's question using the context. Return the answer and provide additional information if necessary.
-
-### Instruction:
-{instruction}
+            return (
+                "Below is a question from a customer to an agent, paired with a potentially useful context. Answer customer's question using the context. Return the answer and provide additional information if necessary.\n\n### Instruction:\n",
+                f"""{instruction}
 
 ### Input:
 {input_ctxt}
 
-### Response:"""
+### Response:""",
+            )
         else:
-            return f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
-
-### Instruction:
-{instruction}
+            return (
+                "Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n### Instruction:\n",
+                f"""{instruction}
 
-### Response:"""
+### Response:""",
+            )
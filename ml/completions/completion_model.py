@@ -1,5 +1,7 @@
 from abc import abstractmethod
+from concurrent.futures import Future
 
+from utils.prompt_logging import PROMPT_LOG
 from utils.schemas import CompletionsInput
 
 
@@ -9,8 +11,9 @@ class CompletionModel:
         pass
 
     @staticmethod
-    def get_completion_subprocess(cls, completions_input: CompletionsInput, state: dict):
-        state[cls.__class__.__name__] = cls.get_completion(completions_input=completions_input)
+    def log_result(future: Future):
+        if not future.cancelled() and future.exception() is None:
+            PROMPT_LOG.log("completions result:", future.result())
 
     @staticmethod
     def postprocess_output(s: str) -> str:
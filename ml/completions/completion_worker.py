@@ -0,0 +1,34 @@
+import asyncio
+
+from loguru import logger
+
+
+async def race_completions(
+    preferred: asyncio.Task, fallback: asyncio.Task, preferred_timeout: float, general_timeout: float
+):
+    """
+    Returns the preferred result if it arrives within `preferred_timeout`, afterwards whichever
+    backend answers first. The other task is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + general_timeout
+    try:
+        await asyncio.wait([preferred], timeout=min(preferred_timeout, general_timeout))
+        if preferred.done() and not preferred.exception():
+            return preferred.result(), preferred.get_name()
+
+        pending = {task for task in (preferred, fallback) if not task.done()}
+        done = {task for task in (preferred, fallback) if task.done()}
+        while True:
+            for task in done:
+                if not task.exception():
+                    return task.result(), task.get_name()
+                logger.warning(f"Completion backend {task.get_name()} failed: {task.exception()}")
+            if not pending or loop.time() >= deadline:
+                raise TimeoutError("No completion backend answered in time")
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED
+            )
+    finally:
+        preferred.cancel()
+        fallback.cancel()
@@ -0,0 +1,263 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, List, Tuple
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16, "int8": torch.float32}
+
+
+def load_weights(model: torch.nn.Module, dtype: str, device: torch.device) -> torch.nn.Module:
+    """Moves the model to `device`; int8 quantizes linear layers dynamically, which only runs on CPU."""
+    model = model.to(device)
+    if dtype == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def to_legacy(past):
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def from_legacy(past):
+    # the legacy tuple format is only understood by transformers 4.x, which requirements.txt pins
+    return DynamicCache.from_legacy_cache(past) if hasattr(DynamicCache, "from_legacy_cache") else past
+
+
+class Sequence:
+    def __init__(self, ids: List[int], future: Future, on_token: Callable[[str], None] | None):
+        self.ids = ids
+        self.future = future
+        self.on_token = on_token
+        self.generated: List[int] = []
+        self.text = ""
+        # number of positions held in the kv cache
+        self.kv_len = 0
+
+
+class GenerationEngine:
+    """
+    Continuous batching for decoder-only models: a single thread runs one decode step for all
+    active sequences at a time, and new requests join the batch between steps instead of waiting
+    for it to finish. The KV cache of shared prompt prefixes is computed once and reused.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: torch.device,
+        max_batch_size: int = 8,
+        max_new_tokens: int = 300,
+        temperature: float = 0.2,
+        top_p: float = 0.75,
+        top_k: int = 40,
+        repetition_penalty: float = 1.2,
+        prefix_cache_size: int = 4,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.prefix_cache_size = prefix_cache_size
+        self.prefixes = OrderedDict()
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, name="generation-engine", daemon=True).start()
+
+    def submit(self, prefix: str, text: str, on_token: Callable[[str], None] | None = None) -> Future:
+        future = Future()
+        self.requests.put((prefix, text, future, on_token))
+        return future
+
+    def run(self):
+        active, past = [], None
+        while True:
+            # block while idle, afterwards only pick up what is already waiting
+            pending = [self.requests.get()] if not active else []
+            while len(active) + len(pending) < self.max_batch_size:
+                try:
+                    pending.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with torch.inference_mode():
+                    for prefix, text, future, on_token in pending:
+                        if future.cancelled():
+                            continue
+                        sequence, sequence_past, logits = self.prefill(prefix, text, future, on_token)
+                        active, past = self.join(active, past, sequence, sequence_past)
+                        self.advance(sequence, logits[0])
+                    active, past = self.evict(active, past)
+                    if active:
+                        active, past = self.evict(active, self.step(active, past))
+            except Exception as e:
+                logger.error(f"Generation failed with {e.__class__.__name__}: {e}")
+                for sequence in active + [Sequence([], future, None) for _, _, future, _ in pending]:
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+                active, past = [], None
+
+    def prefill(self, prefix: str, text: str, future: Future, on_token: Callable[[str], None] | None):
+        prefix_ids, prefix_past = self.prefix_cache(prefix)
+        text_ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        outputs = self.model(
+            input_ids=torch.tensor([text_ids], device=self.device),
+            past_key_values=from_legacy(prefix_past),
+            use_cache=True,
+        )
+        sequence = Sequence(prefix_ids + text_ids, future, on_token)
+        sequence.kv_len = len(sequence.ids)
+        return sequence, to_legacy(outputs.past_key_values), outputs.logits[:, -1]
+
+    def prefix_cache(self, prefix: str) -> Tuple[List[int], tuple]:
+        if prefix in self.prefixes:
+            self.prefixes.move_to_end(prefix)
+            return self.prefixes[prefix]
+        ids = self.tokenizer(prefix).input_ids
+        outputs = self.model(input_ids=torch.tensor([ids], device=self.device), use_cache=True)
+        self.prefixes[prefix] = ids, to_legacy(outputs.past_key_values)
+        if len(self.prefixes) > self.prefix_cache_size:
+            self.prefixes.popitem(last=False)
+        return self.prefixes[prefix]
+
+    def step(self, active: List[Sequence], past: tuple):
+        length = past[0][0].shape[2]
+        attention_mask = torch.zeros((len(active), length + 1), dtype=torch.long, device=self.device)
+        for row, sequence in enumerate(active):
+            attention_mask[row, length - sequence.kv_len :] = 1
+        outputs = self.model(
+            input_ids=torch.tensor([[sequence.generated[-1]] for sequence in active], device=self.device),
+            attention_mask=attention_mask,
+            position_ids=torch.tensor([[sequence.kv_len] for sequence in active], device=self.device),
+            past_key_values=from_legacy(past),
+            use_cache=True,
+        )
+        for row, sequence in enumerate(active):
+            sequence.kv_len += 1
+            self.advance(sequence, outputs.logits[row, -1])
+        return to_legacy(outputs.past_key_values)
+
+    def advance(self, sequence: Sequence, logits: torch.Tensor):
+        token = self.sample(logits, sequence.ids + sequence.generated)
+        sequence.generated.append(token)
+        if token == self.tokenizer.eos_token_id:
+            return
+        # decoding the whole answer keeps the spacing of sentencepiece tokens right
+        text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True).lstrip()
+        if sequence.on_token and len(text) > len(sequence.text):
+            sequence.on_token(text[len(sequence.text) :])
+        sequence.text = text
+
+    def sample(self, logits: torch.Tensor, previous: List[int]) -> int:
+        logits = logits.float()
+        previous = torch.tensor(previous, device=logits.device)
+        scores = logits[previous]
+        logits[previous] = torch.where(scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty)
+        if self.temperature == 0:
+            return int(logits.argmax())
+        logits = logits / self.temperature
+        if self.top_k:
+            logits[logits < torch.topk(logits, self.top_k).values[-1]] = -float("inf")
+        sorted_logits, indices = torch.sort(logits, descending=True)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # keep the smallest set of tokens whose probability reaches top_p
+        sorted_logits[cumulative - torch.softmax(sorted_logits, dim=-1) > self.top_p] = -float("inf")
+        return int(indices[torch.multinomial(torch.softmax(sorted_logits, dim=-1), 1)])
+
+    def join(self, active: List[Sequence], past: tuple | None, sequence: Sequence, sequence_past: tuple):
+        if past is None:
+            return [sequence], sequence_past
+        length = max(past[0][0].shape[2], sequence.kv_len)
+        past = tuple(
+            tuple(
+                torch.cat([self.pad(batch, length), self.pad(new, length)])
+                for batch, new in zip(batch_layer, new_layer)
+            )
+            for batch_layer, new_layer in zip(past, sequence_past)
+        )
+        return active + [sequence], past
+
+    def evict(self, active: List[Sequence], past: tuple | None):
+        keep = []
+        for row, sequence in enumerate(active):
+            if sequence.future.cancelled():
+                continue
+            if sequence.generated[-1] == self.tokenizer.eos_token_id or len(sequence.generated) >= self.max_new_tokens:
+                try:
+                    sequence.future.set_result(sequence.text)
+                except Exception:
+                    # cancelled by the caller in the meantime
+                    pass
+                continue
+            keep.append(row)
+        if not keep:
+            return [], None
+        if len(keep) < len(active):
+            index = torch.tensor(keep, device=self.device)
+            active = [active[row] for row in keep]
+            # left padding which no remaining sequence needs is dropped as well
+            length = max(sequence.kv_len for sequence in active)
+            past = tuple(tuple(tensor.index_select(0, index)[:, :, -length:] for tensor in layer) for layer in past)
+        return active, past
+
+    @staticmethod
+    def pad(tensor: torch.Tensor, length: int) -> torch.Tensor:
+        return F.pad(tensor, (0, 0, length - tensor.shape[2], 0))
+
+
+class DynamicBatcher:
+    """
+    Collects requests arriving within `max_wait` seconds, up to `max_size`, and runs them through
+    one batched call. Used for encoder-decoder models, where sequences can't join a running batch.
+    """
+
+    def __init__(self, func: Callable[[List[str]], List[str]], max_wait: float, max_size: int):
+        self.func = func
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, name="dynamic-batcher", daemon=True).start()
+
+    def submit(self, prompt: str) -> Future:
+        future = Future()
+        self.requests.put((prompt, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            batch = [(prompt, future) for prompt, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                results = self.func([prompt for prompt, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
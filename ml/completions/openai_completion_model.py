@@ -1,38 +1,60 @@
 import asyncio
+import math
+import re
+import time
 from pprint import pformat
+from typing import Any, AsyncIterator, List, Tuple
 
 import openai
 import tiktoken
-from fastapi.responses import StreamingResponse
+from fastapi import HTTPException, Request, status
 from loguru import logger
 
+from data import SUMMARIZATION_PROMPT
 from ml.completions import CompletionModel
 from utils import CONFIG
-from utils.misc import retry_with_time_limit
-from utils.schemas import AnswerInContextResponse, ApiVersion, CompletionsInput, CompletionsResponse, SummarizationInput
+from utils.cache import CompletionCache
+from utils.metrics import COMPLETION_TOKENS, PROMPT_TOKENS, TOKENIZATION_LATENCY
+from utils.misc import hedged
+from utils.prompt_logging import PROMPT_LOG
+from utils.retry import UPSTREAMS
+from utils.schemas import (
+    AnswerInContextResponse,
+    ApiVersion,
+    CompletionsInput,
+    CompletionsResponse,
+    SummarizationInput,
+    TokenUsage,
+)
+from utils.sse import sse_response
+from utils.text import pack_units, split_text
+from utils.tokens import TokenCounter
 
 
 class OpenAICompletionModel(CompletionModel):
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, cache: CompletionCache | None = None):
         self.model_name = model_name
+        self.cache = cache
         self.enc = tiktoken.get_encoding("cl100k_base")
+        self.tokens = TokenCounter(self.enc)
+        self.digit_tokens = [self.enc.encode(str(digit))[0] for digit in range(10)]
 
     async def if_answer_in_context(
-        self, completions_input: CompletionsInput, api_version: ApiVersion
+        self, completions_input: CompletionsInput, api_version: ApiVersion, threshold: float | None = None
     ) -> AnswerInContextResponse:
         messages = [
             {
                 "role": "system",
                 # "content": "You are a classification AI. You tell 1 if the answer is in the context and 0 if it is not.",
-                "content": "You are a classification AI. You respond with a confidence score from 1 to 10. You are trying to predict if the answer is in the context.",
+                "content": "You are a classification AI. You respond with a single digit confidence score from 0 to 9. You are trying to predict if the answer is in the context.",
             },
             {
                 "role": "user",
                 # "content": f"You are given some texts and a question. You need to tell if the answer to the question is in the texts.\nThe text might be relevant to the question, but the answer might not be in the text.\nYou should respond only with one symbol: 1 if answer to a given query contained in the provided text and 0 otherwise.\n\nText:\n\"\"\"\n"
-                "content": f"You are given some texts and a question. You need to tell if the answer to the question is in the texts.\nThe text might be relevant to the question, but the answer might not be in the text.\nYou should respond with confidence score from 1 to 10 if answer to a given query contained in the text.\n\nText:\n\"\"\"\n"
+                "content": f"You are given some texts and a question. You need to tell if the answer to the question is in the texts.\nThe text might be relevant to the question, but the answer might not be in the text.\nYou should respond with a single digit confidence score from 0 to 9 if answer to a given query contained in the text.\n\nText:\n\"\"\"\n"
                 + (completions_input.info or "")
                 + (
-                    "\n".join([f"{msg['role']}: {msg['content']}" for msg in completions_input.chat])
+                    "\n".join([f"{msg.role.value}: {msg.content}" for msg in completions_input.chat])
                     if completions_input.chat
                     else ""
                 )
@@ -41,29 +63,49 @@ class OpenAICompletionModel(CompletionModel):
                 + "\n\"\"\"",
             },
         ]
-        logger.info(
-            "completions request:"
-            + '\n'
-            + '\n=============================\n'.join(
-                [f"{message['role']}: {message['content']}" for message in messages]
+        sampled = PROMPT_LOG.sample()
+        if sampled:
+            PROMPT_LOG.log(
+                "completions request:",
+                '\n=============================\n'.join(
+                    [f"{message['role']}: {message['content']}" for message in messages]
+                ),
             )
-        )
         args = {
             "model": CONFIG["v1.completions"]["model"]
             if api_version == ApiVersion.v1
             else CONFIG["v2.completions"]["model"],
             "messages": messages,
-            "temperature": 0.4,
-            "max_tokens": 5,
+            "temperature": 0,
+            # the answer is constrained to one digit token, its distribution is the confidence
+            "max_tokens": 1,
+            "logit_bias": {token: 100 for token in self.digit_tokens},
         }
-        answer = await retry_with_time_limit(openai.ChatCompletion.acreate, time_limit=5, max_retries=3, **args)
-        answer = int(answer["choices"][0]["message"]["content"].lstrip())
-        logger.info("completions result:" + '\n' + str(answer))
-        answer = answer >= 5
-        # answer = bool(int(answer["choices"][0]["message"]["content"].lstrip()))
-        return AnswerInContextResponse(answer=answer)
-
-    async def get_completion(self, completions_input: CompletionsInput, api_version: ApiVersion) -> CompletionsResponse:
+        if CONFIG["answer_in_context"].getboolean("logprobs"):
+            args |= {"logprobs": True, "top_logprobs": 10}
+        answer = await UPSTREAMS["openai.completions"].call(
+            openai.ChatCompletion.acreate, time_limit=5, max_retries=3, **args
+        )
+        confidence = self.score_confidence(answer["choices"][0])
+        if sampled:
+            PROMPT_LOG.log("completions result:", str(confidence))
+        threshold = float(CONFIG["answer_in_context"]["threshold"]) if threshold is None else threshold
+        return AnswerInContextResponse(answer=confidence >= threshold, confidence=confidence)
+
+    @staticmethod
+    def score_confidence(choice: dict) -> float:
+        """Expected score over the digit tokens, scaled to [0, 1]."""
+        top_logprobs = ((choice.get("logprobs") or {}).get("content") or [{}])[0].get("top_logprobs") or []
+        scores = {int(item["token"]): math.exp(item["logprob"]) for item in top_logprobs if item["token"].isdigit()}
+        if not scores:
+            # models without logprobs still answer with a single digit thanks to the logit bias
+            digits = re.findall(r"\d", choice["message"]["content"] or "")
+            return int(digits[0]) / 9 if digits else 0.0
+        return sum(score * prob for score, prob in scores.items()) / sum(scores.values()) / 9
+
+    async def get_completion(
+        self, completions_input: CompletionsInput, api_version: ApiVersion, request: Request | None = None
+    ) -> CompletionsResponse:
         messages = [
             {
                 "role": "system",
@@ -87,34 +129,43 @@ class OpenAICompletionModel(CompletionModel):
             },
         ]
 
-        if completions_input.chat:
-            messages += [msg.dict() for msg in completions_input.chat]
-            messages[-1]["content"] = (
-                f"\"\"\"\n{completions_input.info}\n\"\"\"" + f"\n\nQuestion: {messages[-1]['content']}"
+        config_section = "v1.completions" if api_version == ApiVersion.v1 else "v2.completions"
+        max_tokens = 500
+        with TOKENIZATION_LATENCY.labels("fit_prompt").time():
+            chat, info, usage = self.fit_prompt(
+                messages[0]["content"],
+                completions_input,
+                context_window=int(CONFIG[config_section]["context_window"]),
+                max_tokens=max_tokens,
             )
 
-        if completions_input.query and not completions_input.chat:
+        if chat:
+            messages += chat
+            messages[-1]["content"] = f"\"\"\"\n{info}\n\"\"\"" + f"\n\nQuestion: {messages[-1]['content']}"
+
+        if completions_input.query and not chat:
             messages.append(
                 {
                     "role": "user",
-                    "content": f"\"\"\"\n{completions_input.info}\n\"\"\"" + f"\n\nQuestion: {completions_input.query}",
+                    "content": f"\"\"\"\n{info}\n\"\"\"" + f"\n\nQuestion: {completions_input.query}",
                 }
             )
+        usage.prompt_tokens = self.tokens.count_messages(messages)
+        PROMPT_TOKENS.labels(CONFIG[config_section]["model"]).observe(usage.prompt_tokens)
 
-        logger.info(
-            "completions request:"
-            + '\n'
-            + '\n@@@@@@@@@@@@@@@@@@@@@@@@@@@@@\n'.join(
-                [f"{message['role']}: {message['content']}" for message in messages]
+        sampled = PROMPT_LOG.sample()
+        if sampled:
+            PROMPT_LOG.log(
+                "completions request:",
+                '\n@@@@@@@@@@@@@@@@@@@@@@@@@@@@@\n'.join(
+                    [f"{message['role']}: {message['content']}" for message in messages]
+                ),
             )
-        )
         args = {
-            "model": CONFIG["v1.completions"]["model"]
-            if api_version == ApiVersion.v1
-            else CONFIG["v2.completions"]["model"],
+            "model": CONFIG[config_section]["model"],
             "messages": messages,
             "temperature": 0.0,
-            "max_tokens": 500,
+            "max_tokens": max_tokens,
             "stream": completions_input.stream,
             "frequency_penalty": 1.0,
             "presence_penalty": 1.0,
@@ -126,72 +177,209 @@ class OpenAICompletionModel(CompletionModel):
                 "2246": -100,  # documents
             },
         }
+        # sampling with temperature makes every answer different, so only greedy answers are cached
+        cache = self.cache if self.cache and args["temperature"] == 0 else None
+        cached = await asyncio.to_thread(cache.get, args) if cache else None
+        if cached is not None:
+            logger.info("completions result is taken from cache")
+
         if not completions_input.stream:
-            answer = await openai.ChatCompletion.acreate(**args)
-            answer = self.postprocess_output(answer["choices"][0]["message"]["content"].strip())
-            logger.info("completions result:" + '\n' + answer)
-            return CompletionsResponse(data=answer)
+            if cached is None:
+                answer = await UPSTREAMS["openai.completions"].call(
+                    hedged(openai.ChatCompletion.acreate, key=f"completions:{args['model']}"), time_limit=60, **args
+                )
+                cached = answer["choices"][0]["message"]["content"]
+                usage.completion_tokens = answer["usage"]["completion_tokens"]
+                COMPLETION_TOKENS.labels(args["model"]).observe(usage.completion_tokens)
+                if cache:
+                    await asyncio.to_thread(cache.set, args, cached)
+            else:
+                usage.completion_tokens = self.tokens.count(cached)
+            answer = self.postprocess_output(cached.strip())
+            if sampled:
+                PROMPT_LOG.log("completions result:", answer)
+            return CompletionsResponse(data=answer, usage=usage)
         else:
-            answer = await retry_with_time_limit(openai.ChatCompletion.acreate, time_limit=4, max_retries=3, **args)
-            answer = (
-                CompletionsResponse(
-                    data=message["choices"][0]["delta"]["content"]
-                    if "content" in message["choices"][0]["delta"]
-                    else ""
-                ).json()
-                async for message in answer
+            if cached is not None:
+                deltas = self.replay_stream(cached)
+            else:
+                answer = await UPSTREAMS["openai.completions"].call(
+                    hedged(openai.ChatCompletion.acreate, key=f"completions-stream:{args['model']}"),
+                    time_limit=4,
+                    max_retries=3,
+                    **args,
+                )
+                deltas = self.read_stream(answer, args, cache)
+            return sse_response(
+                request,
+                deltas,
+                headers={
+                    'X-Prompt-Tokens': str(usage.prompt_tokens),
+                    'X-Trimmed-Messages': str(usage.trimmed_messages),
+                    'X-Truncated-Info-Tokens': str(usage.truncated_info_tokens),
+                },
+            )
+
+    async def read_stream(self, stream, args: dict, cache: CompletionCache | None):
+        parts = []
+        async for message in stream:
+            delta = message["choices"][0]["delta"].get("content", "")
+            parts.append(delta)
+            yield delta
+        COMPLETION_TOKENS.labels(args["model"]).observe(self.tokens.count("".join(parts)))
+        # only fully received answers are cached
+        if cache:
+            await asyncio.to_thread(cache.set, args, "".join(parts))
+
+    @staticmethod
+    async def replay_stream(answer: str):
+        for chunk in re.findall(r"\s*\S+\s*$|\s*\S+", answer):
+            yield chunk
+
+    def fit_prompt(
+        self, system_prompt: str, completions_input: CompletionsInput, context_window: int, max_tokens: int
+    ) -> Tuple[List[dict], str | None, TokenUsage]:
+        """
+        Drops the oldest chat turns and then cuts the end of `info` until the prompt fits into
+        the context window with `max_tokens` left for the answer.
+        """
+        chat = [msg.dict() for msg in completions_input.chat or []]
+        info = completions_input.info
+        question = chat[-1]["content"] if chat else completions_input.query or ""
+        # the last message carries the question and is never dropped, 16 tokens are left for quotes and labels
+        budget = context_window - max_tokens - self.tokens.count_messages([{"content": system_prompt}]) - 16
+        budget -= self.tokens.count(question) + 4
+        history = [self.tokens.count(msg["content"]) + 4 for msg in chat[:-1]]
+        info_tokens = self.tokens.count(info) if info else 0
+
+        usage = TokenUsage(prompt_tokens=0)
+        while history and sum(history) + info_tokens > budget:
+            chat.pop(0)
+            history.pop(0)
+            usage.trimmed_messages += 1
+        room = budget - sum(history)
+        # the question alone may not fit, and info cut to nothing would be misleading
+        if room < 0 or (room == 0 and info_tokens):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Question does not fit into the context window of {context_window} tokens",
             )
-            return StreamingResponse(answer, media_type='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+        if info and info_tokens > room:
+            info = self.tokens.truncate(info, room)
+            usage.truncated_info_tokens = info_tokens - room
+        if usage.trimmed_messages or usage.truncated_info_tokens:
+            logger.warning(
+                f"Prompt does not fit into {context_window} tokens: dropped {usage.trimmed_messages} chat messages "
+                f"and {usage.truncated_info_tokens} info tokens"
+            )
+        return chat, info, usage
 
     async def get_summarization(
-        self, summarization_input: SummarizationInput, api_version: ApiVersion
+        self, summarization_input: SummarizationInput, api_version: ApiVersion, request: Request | None = None
     ) -> CompletionsResponse:
-        prompt = (
-            lambda text: f"Can you provide a comprehensive summary of the given article from a knowledge base? The summary should cover all the key points and main ideas presented in the original text, while also condensing the information into a concise and easy-to-understand format. Please ensure that the summary includes relevant details and examples that support the main ideas, while avoiding any unnecessary information or repetition. The length of the summary should be appropriate for the length and complexity of the original text, providing a clear and accurate overview without omitting any important information.\n\nText:\n\"\"\"\n{text}\n\"\"\""
-        )
-        max_request_size = 15_000
         args = {
-            "model": "gpt-3.5-turbo-16k",
+            "model": CONFIG["summarization"]["model"],
             "temperature": 0.6,
             "max_tokens": summarization_input.max_tokens,
         }
-        text, length = summarization_input.info, len(self.enc.encode(summarization_input.info))
-        while length > max_request_size:
-            logger.warning(f"Splitting summarization request into {length // max_request_size + 1} parts")
-            n_parts = length // max_request_size + 1
-            tasks = []
-            for i in range(n_parts):
-                start = i * length // n_parts
-                end = (i + 1) * length // n_parts
-                tasks.append(
-                    openai.ChatCompletion.acreate(
-                        messages=[{"role": "user", "content": prompt(text[start:end])}],
-                        **args,
-                    )
-                )
-            results = await asyncio.gather(*tasks)
-            text = "".join(
-                [self.postprocess_output(result["choices"][0]["message"]["content"].lstrip()) for result in results]
-            )
-            length = len(self.enc.encode(text))
+        events = self.map_reduce(summarization_input.info, args)
+        if summarization_input.stream and summarization_input.progress:
+            return sse_response(request, self.stream_summarization(events, args))
+        async for event, payload in events:
+            if event == "result":
+                text = payload
 
-        args["messages"] = [{"role": "user", "content": prompt(text)}]
+        args["messages"] = [{"role": "user", "content": SUMMARIZATION_PROMPT(text)}]
         args["stream"] = summarization_input.stream
         if not summarization_input.stream:
-            answer = await openai.ChatCompletion.acreate(**args)
+            answer = await UPSTREAMS["openai.completions"].call(openai.ChatCompletion.acreate, time_limit=120, **args)
             answer = self.postprocess_output(answer["choices"][0]["message"]["content"].lstrip())
             return CompletionsResponse(data=answer)
         else:
-            answer = await retry_with_time_limit(openai.ChatCompletion.acreate, time_limit=4, max_retries=3, **args)
-            answer = (
-                CompletionsResponse(
-                    data=message["choices"][0]["delta"]["content"]
-                    if "content" in message["choices"][0]["delta"]
-                    else ""
-                ).json()
-                async for message in answer
+            answer = await UPSTREAMS["openai.completions"].call(
+                openai.ChatCompletion.acreate, time_limit=4, max_retries=3, **args
+            )
+            return sse_response(request, self.read_stream(answer, args, cache=None))
+
+    async def stream_summarization(self, events: AsyncIterator[Tuple[str, Any]], args: dict):
+        async for event, payload in events:
+            if event == "result":
+                text = payload
+            else:
+                yield event, payload
+
+        args["messages"] = [{"role": "user", "content": SUMMARIZATION_PROMPT(text)}]
+        answer = await UPSTREAMS["openai.completions"].call(
+            openai.ChatCompletion.acreate, time_limit=4, max_retries=3, stream=True, **args
+        )
+        async for delta in self.read_stream(answer, args, cache=None):
+            yield delta
+
+    async def map_reduce(self, text: str, args: dict) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Yields ("partial", ...) for every chunk summary as soon as it is ready, ("progress", ...)
+        after every finished request and finally ("result", text) with the text to summarize.
+        """
+        max_request_tokens = int(CONFIG["summarization"]["max_request_tokens"])
+        start = time.perf_counter()
+        chunks = await asyncio.to_thread(
+            split_text,
+            self.enc,
+            text,
+            max_tokens=max_request_tokens,
+            overlap_tokens=int(CONFIG["summarization"]["overlap_tokens"]),
+        )
+        TOKENIZATION_LATENCY.labels("split_text").observe(time.perf_counter() - start)
+        if len(chunks) == 1:
+            yield "result", text
+            return
+
+        logger.warning(f"Splitting summarization request into {len(chunks)} parts")
+        semaphore = asyncio.Semaphore(int(CONFIG["summarization"]["concurrency"]))
+        yield "progress", {"stage": "map", "done": 0, "total": len(chunks)}
+        summaries = [None] * len(chunks)
+        tasks = [
+            asyncio.create_task(self.summarize_part(chunk, args, semaphore, idx)) for idx, chunk in enumerate(chunks)
+        ]
+        try:
+            for done, task in enumerate(asyncio.as_completed(tasks), 1):
+                idx, summary = await task
+                summaries[idx] = summary
+                yield "partial", {"index": idx, "data": summary[0]}
+                yield "progress", {"stage": "map", "done": done, "total": len(chunks)}
+        finally:
+            # the client may go away in the middle of the map phase
+            for task in tasks:
+                task.cancel()
+
+        # summaries are merged in a tree: every round packs as many of them as fits into one request
+        reduce_round = 0
+        while sum(tokens for _, tokens in summaries) > max_request_tokens:
+            reduce_round += 1
+            groups = pack_units(summaries, max_tokens=max_request_tokens)
+            logger.warning(f"Reduce round #{reduce_round}: merging {len(summaries)} summaries into {len(groups)}")
+            yield "progress", {"stage": "reduce", "round": reduce_round, "total": len(groups)}
+            summaries = [
+                summary
+                for _, summary in await asyncio.gather(
+                    *[self.summarize_part(group, args, semaphore) for group in groups]
+                )
+            ]
+        yield "result", "\n\n".join(summary for summary, _ in summaries)
+
+    async def summarize_part(
+        self, text: str, args: dict, semaphore: asyncio.Semaphore, idx: int = 0
+    ) -> Tuple[int, Tuple[str, int]]:
+        async with semaphore:
+            answer = await UPSTREAMS["openai.completions"].call(
+                openai.ChatCompletion.acreate,
+                time_limit=int(CONFIG["summarization"]["time_limit"]),
+                max_retries=int(CONFIG["summarization"]["max_retries"]),
+                messages=[{"role": "user", "content": SUMMARIZATION_PROMPT(text)}],
+                **args,
             )
-            return StreamingResponse(answer, media_type='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+        summary = self.postprocess_output(answer["choices"][0]["message"]["content"].strip())
+        return idx, (summary, self.tokens.count(summary) + 1)
 
     @staticmethod
     def get_system_prompt(completions_input: CompletionsInput) -> str:
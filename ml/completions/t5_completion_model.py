@@ -1,35 +1,71 @@
+from concurrent.futures import Future
+from typing import Callable, List
+
 import torch
 from loguru import logger
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 
 from data import COMPLETIONS_PROMPT_CUSTOM, COMPLETIONS_PROMPT_OPENAI_NO_INFO
 from ml.completions import CompletionModel
+from ml.completions.generation import DTYPES, DynamicBatcher, load_weights
+from utils.prompt_logging import PROMPT_LOG
 from utils.schemas import CompletionsInput
 
 
 class T5CompletionModel(CompletionModel):
-    def __init__(self, model_name: str, device: str):
-        logger.info(f"Loading {model_name} model to {device}")
+    def __init__(
+        self,
+        model_name: str,
+        device: str,
+        dtype: str = "float32",
+        threads: int = 0,
+        max_batch_size: int = 8,
+        batch_window: float = 0.01,
+    ):
+        logger.info(f"Loading {model_name} model to {device} in {dtype}")
         self.device = torch.device(device)
+        if threads:
+            torch.set_num_threads(threads)
         self.tokenizer = T5Tokenizer.from_pretrained(model_name)
-        self.model = T5ForConditionalGeneration.from_pretrained(model_name).to(self.device)
+        self.model = load_weights(
+            T5ForConditionalGeneration.from_pretrained(model_name, torch_dtype=DTYPES[dtype]), dtype, self.device
+        )
         # self.model.share_memory()
+        self.concurrency = max_batch_size
+        self.batcher = DynamicBatcher(self.generate, max_wait=batch_window, max_size=max_batch_size)
 
     def get_completion(self, completions_input: CompletionsInput) -> str:
+        return self.submit_completion(completions_input).result()
+
+    def submit_completion(
+        self, completions_input: CompletionsInput, on_token: Callable[[str], None] | None = None
+    ) -> Future:
         prompt = (
             COMPLETIONS_PROMPT_CUSTOM(completions_input.info.replace("\n\n", "\n"), completions_input.query)
             if completions_input.info
             else COMPLETIONS_PROMPT_OPENAI_NO_INFO(completions_input.query)
         )
-        logger.info("completions request:" + "\n" + prompt)
-        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
-        outputs = self.model.generate(
-            input_ids,
-            temperature=1.0,
-            min_length=10,
-            max_new_tokens=300,
-            repetition_penalty=2.5,
-        )
-        answer = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        logger.info("completions result:" + "\n" + answer)
-        return answer
+        future = self.batcher.submit(prompt)
+        if on_token:
+            # the whole batch is generated at once, so the answer arrives as a single delta
+            def deliver(done: Future):
+                if not done.cancelled() and done.exception() is None:
+                    on_token(done.result())
+
+            future.add_done_callback(deliver)
+        if PROMPT_LOG.sample():
+            PROMPT_LOG.log("completions request:", prompt)
+            future.add_done_callback(self.log_result)
+        return future
+
+    def generate(self, prompts: List[str]) -> List[str]:
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                temperature=1.0,
+                min_length=10,
+                max_new_tokens=300,
+                repetition_penalty=2.5,
+            )
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
@@ -1,12 +1,49 @@
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
+import numpy as np
+import torch
 from InstructorEmbedding import INSTRUCTOR
+from loguru import logger
+
+from utils.batching import MicroBatcher
 
 
 class EmbeddingModel:
-    def __init__(self, model_name: str, device: str):
+    def __init__(
+        self,
+        model_name: str,
+        device: str,
+        threads: int = 0,
+        batch_size: int = 32,
+        batch_window: float = 0.01,
+        max_batch_size: int = 256,
+        max_batch_tokens: int = 16384,
+    ):
+        logger.info(f"Loading {model_name} model to {device}")
+        if threads:
+            torch.set_num_threads(threads)
         self.model = INSTRUCTOR(model_name_or_path=model_name, device=device)
+        self.batch_size = batch_size
+        # inference runs in a single dedicated thread, so the event loop never waits for a forward pass
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings")
+        self.batcher = MicroBatcher(
+            self.encode,
+            max_wait=batch_window,
+            max_size=max_batch_size,
+            max_tokens=max_batch_tokens,
+            count_tokens=lambda pair: len(self.model.tokenizer.tokenize(pair[0] + pair[1])) + 2,
+        )
+
+    async def get_embeddings(self, input: List[str], instruction: str) -> np.ndarray:
+        return np.stack(await asyncio.gather(*[self.batcher.submit((instruction, text)) for text in input]))
 
-    def get_embeddings(self, input: List[str], instruction: str) -> List[List[float]]:
-        embeddings = self.model.encode(sentences=[[instruction, text] for text in input])
-        return embeddings.tolist()
+    async def encode(self, pairs: List[Tuple[str, str]]) -> List[np.ndarray]:
+        # encode sorts the whole coalesced batch by length before splitting it into
+        # `batch_size` chunks, so texts of similar length end up padded together
+        embeddings = await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: self.model.encode(sentences=[list(pair) for pair in pairs], batch_size=self.batch_size),
+        )
+        return list(embeddings)
@@ -0,0 +1,220 @@
+import asyncio
+import itertools
+import os
+import os.path as osp
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
+from typing import AsyncIterator, Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from utils import CONFIG
+from utils.schemas import CompletionsInput
+
+AUTHKEY_ENV = "COREML_MODEL_SERVER_AUTHKEY"
+
+model_server_process = None
+
+
+class ModelServerManager(BaseManager):
+    pass
+
+
+class ModelHost:
+    """Holds local models inside the model server process, one copy for all gunicorn workers."""
+
+    def __init__(self, models: List[str]):
+        # async model APIs (dynamic batching) run on a private loop shared by all connections
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="model-host-loop", daemon=True).start()
+        self.embedding_model, self.completion_model = None, None
+        self.jobs: Dict[int, Future] = {}
+        self.streams: Dict[int, queue.Queue] = {}
+        self.job_ids = itertools.count()
+
+        if "embeddings" in models:
+            from ml.embeddings import EmbeddingModel
+
+            self.embedding_model = EmbeddingModel(
+                model_name=CONFIG["v3.embeddings"]["model"],
+                device=CONFIG["v3.embeddings"]["device"],
+                threads=int(CONFIG["v3.embeddings"]["threads"]),
+                batch_size=int(CONFIG["v3.embeddings"]["batch_size"]),
+                batch_window=int(CONFIG["v3.embeddings"]["batch_window_ms"]) / 1000,
+                max_batch_size=int(CONFIG["v3.embeddings"]["max_batch_size"]),
+                max_batch_tokens=int(CONFIG["v3.embeddings"]["max_batch_tokens"]),
+            )
+        if "alpaca" in models:
+            from ml.completions import AlpacaCompletionModel
+
+            self.completion_model = AlpacaCompletionModel(
+                model_name=CONFIG["v3.completions"]["model"],
+                device=CONFIG["v3.completions"]["device"],
+                dtype=CONFIG["v3.completions"]["dtype"],
+                threads=int(CONFIG["v3.completions"]["threads"]),
+                max_batch_size=int(CONFIG["v3.completions"]["max_batch_size"]),
+                prefix_cache_size=int(CONFIG["v3.completions"]["prefix_cache_size"]),
+            )
+
+    def get_embeddings(self, input: List[str], instruction: str) -> np.ndarray:
+        return asyncio.run_coroutine_threadsafe(
+            self.embedding_model.get_embeddings(input=input, instruction=instruction), self.loop
+        ).result()
+
+    def submit_completion(self, completions_input: CompletionsInput, stream: bool = False) -> int:
+        # every connection is served by its own thread, the generation engine batches them together
+        job_id = next(self.job_ids)
+        if not stream:
+            self.jobs[job_id] = self.completion_model.submit_completion(completions_input)
+            return job_id
+        deltas = self.streams[job_id] = queue.Queue()
+        self.jobs[job_id] = self.completion_model.submit_completion(completions_input, on_token=deltas.put)
+        # all deltas are put by the engine thread before the future is resolved
+        self.jobs[job_id].add_done_callback(lambda _: deltas.put(None))
+        return job_id
+
+    def wait_completion(self, job_id: int) -> str:
+        try:
+            return self.jobs[job_id].result()
+        finally:
+            self.jobs.pop(job_id, None)
+
+    def read_deltas(self, job_id: int, timeout: float = 1) -> Tuple[List[str], bool]:
+        """Returns the deltas generated since the last call and whether the answer is complete."""
+        deltas = self.streams[job_id]
+        try:
+            items = [deltas.get(timeout=timeout)]
+        except queue.Empty:
+            return [], False
+        while items[-1] is not None:
+            try:
+                items.append(deltas.get_nowait())
+            except queue.Empty:
+                return items, False
+        self.streams.pop(job_id, None)
+        # raises the error of a failed generation
+        self.jobs.pop(job_id).result()
+        return items[:-1], True
+
+    def cancel_completion(self, job_id: int):
+        self.streams.pop(job_id, None)
+        future = self.jobs.pop(job_id, None)
+        if future is not None:
+            future.cancel()
+
+
+class RemoteEmbeddingModel:
+    """Worker-side stand-in for `EmbeddingModel` which forwards calls to the model server."""
+
+    def __init__(self, host):
+        self.host = host
+
+    async def get_embeddings(self, input: List[str], instruction: str) -> np.ndarray:
+        return await asyncio.to_thread(self.host.get_embeddings, input, instruction)
+
+
+class RemoteCompletionModel:
+    """Worker-side stand-in for local `CompletionModel`s which forwards calls to the model server."""
+
+    def __init__(self, host):
+        self.host = host
+
+    async def get_completion(self, completions_input: CompletionsInput) -> str:
+        job_id = await self.submit(completions_input, stream=False)
+        try:
+            return await asyncio.to_thread(self.host.wait_completion, job_id)
+        except asyncio.CancelledError:
+            # a caller which lost interest, e.g. the slower side of a race, frees its slot in the batch
+            self.cancel(job_id)
+            raise
+
+    async def stream_completion(self, completions_input: CompletionsInput) -> AsyncIterator[str]:
+        job_id = await self.submit(completions_input, stream=True)
+        finished = False
+        try:
+            while not finished:
+                deltas, finished = await asyncio.to_thread(self.host.read_deltas, job_id)
+                for delta in deltas:
+                    yield delta
+        finally:
+            # the client went away or the stream failed
+            if not finished:
+                self.cancel(job_id)
+
+    async def submit(self, completions_input: CompletionsInput, stream: bool) -> int:
+        submit = asyncio.ensure_future(asyncio.to_thread(self.host.submit_completion, completions_input, stream))
+        try:
+            return await asyncio.shield(submit)
+        except asyncio.CancelledError:
+            # the job may be submitted nevertheless, it is cancelled as soon as its id is known
+            submit.add_done_callback(self.cancel_submitted)
+            raise
+
+    def cancel_submitted(self, submit: asyncio.Future):
+        if not submit.cancelled() and submit.exception() is None:
+            self.cancel(submit.result())
+
+    def cancel(self, job_id: int):
+        asyncio.get_running_loop().run_in_executor(None, self.host.cancel_completion, job_id)
+
+
+def serve(address: str, authkey: bytes, models: List[str]):
+    if osp.exists(address):
+        os.remove(address)
+    host = ModelHost(models)
+    ModelServerManager.register("host", callable=lambda: host)
+    manager = ModelServerManager(address=address, authkey=authkey)
+    logger.info(f"Model server with {', '.join(models)} is listening on {address}")
+    manager.get_server().serve_forever()
+
+
+def start_model_server(server=None):
+    # gunicorn `on_starting` hook: models are loaded once, before any worker is forked
+    authkey = os.environ.setdefault(AUTHKEY_ENV, secrets.token_hex(16)).encode()
+    global model_server_process
+    model_server_process = get_context("spawn").Process(
+        target=serve,
+        args=(CONFIG["model_server"]["address"], authkey, CONFIG["model_server"]["models"].split(",")),
+        name="model-server",
+        daemon=True,
+    )
+    model_server_process.start()
+
+
+def stop_model_server(server=None):
+    # gunicorn `on_exit` hook
+    if model_server_process is not None:
+        model_server_process.terminate()
+        model_server_process.join()
+
+
+def connect_model_server():
+    ModelServerManager.register("host")
+    manager = ModelServerManager(address=CONFIG["model_server"]["address"], authkey=os.environ[AUTHKEY_ENV].encode())
+    # the server may still be loading weights when workers boot
+    deadline = time.time() + int(CONFIG["model_server"]["connect_timeout"])
+    while True:
+        try:
+            manager.connect()
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+    logger.info(f"Connected to model server on {CONFIG['model_server']['address']}")
+    return manager.host()
+
+
+if __name__ == "__main__":
+    # sidecar mode: `COREML_MODEL_SERVER_AUTHKEY=... python -m ml.model_server`
+    serve(
+        CONFIG["model_server"]["address"],
+        os.environ[AUTHKEY_ENV].encode(),
+        CONFIG["model_server"]["models"].split(","),
+    )
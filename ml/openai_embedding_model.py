@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import time
+from typing import List
+
+import numpy as np
+import openai
+import tiktoken
+from loguru import logger
+
+from utils.batching import MicroBatcher
+from utils.cache import EmbeddingCache
+from utils.metrics import TOKENIZATION_LATENCY
+from utils.misc import hedged
+from utils.retry import UPSTREAMS
+
+
+class OpenAIEmbeddingModel:
+    def __init__(
+        self,
+        model_name: str,
+        cache: EmbeddingCache | None = None,
+        batch_window: float = 0.0,
+        batch_max_size: int = 256,
+        batch_max_tokens: int = 8000,
+        max_request_size: int = 2048,
+        max_request_tokens: int = 100_000,
+        concurrency: int = 8,
+        request_timeout: float = 20,
+        max_retries: int = 3,
+        repair_rounds: int = 3,
+    ):
+        self.model_name = model_name
+        self.cache = cache
+        self.enc = tiktoken.get_encoding("cl100k_base")
+        self.max_request_size = max_request_size
+        self.max_request_tokens = max_request_tokens
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.repair_rounds = repair_rounds
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # single-text requests arriving within `batch_window` seconds share one upstream call
+        self.batcher = (
+            MicroBatcher(
+                lambda input: self.embed(input, hedge=True),
+                max_wait=batch_window,
+                max_size=batch_max_size,
+                max_tokens=batch_max_tokens,
+                count_tokens=lambda text: len(self.enc.encode(text)),
+            )
+            if batch_window > 0
+            else None
+        )
+
+    async def get_embeddings(self, input: List[str]) -> np.ndarray:
+        if not self.cache:
+            return np.stack(await self.embed_misses(input))
+
+        embeddings = await asyncio.to_thread(self.cache.get, self.model_name, input)
+        # the same text may appear several times in a batch, embed it only once
+        misses = list(dict.fromkeys(text for text, embedding in zip(input, embeddings) if embedding is None))
+        hits = sum(embedding is not None for embedding in embeddings)
+        logger.info(f"Embeddings cache: {hits} hits, {len(input) - hits} misses")
+        if misses:
+            computed = dict(zip(misses, await self.embed_misses(misses)))
+            await asyncio.to_thread(self.cache.set, self.model_name, misses, list(computed.values()))
+            embeddings = [
+                embedding if embedding is not None else computed[text] for text, embedding in zip(input, embeddings)
+            ]
+        return np.stack(embeddings)
+
+    async def embed_misses(self, input: List[str]) -> List[np.ndarray]:
+        if len(input) == 1 and self.batcher:
+            return [await self.batcher.submit(input[0])]
+        return await self.embed(input, hedge=len(input) == 1)
+
+    async def embed(self, input: List[str], hedge: bool = False) -> List[np.ndarray]:
+        embeddings = await self.request(input, hedge=hedge)
+
+        # upstream occasionally returns embeddings of length 1, re-request all of them at once
+        degenerate = [i for i, embedding in enumerate(embeddings) if len(embedding) == 1]
+        start, repair_round = time.time(), 0
+        while degenerate and repair_round < self.repair_rounds:
+            repair_round += 1
+            logger.warning(f"Faced {len(degenerate)} embeddings of length 1. Repair round #{repair_round}...")
+            for i, embedding in zip(degenerate, await self.request([input[i] for i in degenerate], hedge=hedge)):
+                embeddings[i] = embedding
+            degenerate = [i for i in degenerate if len(embeddings[i]) == 1]
+        if repair_round:
+            logger.warning(
+                f"Repair finished in {repair_round} rounds and {round(time.time() - start, 2)} seconds, "
+                f"{len(degenerate)} embeddings left degenerate"
+            )
+        if degenerate:
+            raise ValueError(f"Received embeddings of length 1 on places {degenerate}")
+        return embeddings
+
+    async def request(self, input: List[str], hedge: bool = False) -> List[np.ndarray]:
+        if len(input) == 1:
+            return await self.embed_shard(input, hedge=hedge)
+        shards = await asyncio.to_thread(self.split, input)
+        if len(shards) > 1:
+            logger.info(f"Splitting {len(input)} texts into {len(shards)} requests")
+        results = await asyncio.gather(*[self.embed_shard(shard, hedge=hedge) for shard in shards])
+        return [embedding for result in results for embedding in result]
+
+    def split(self, input: List[str]) -> List[List[str]]:
+        with TOKENIZATION_LATENCY.labels("embeddings_split").time():
+            counts = list(map(len, self.enc.encode_ordinary_batch(input)))
+        shards, shard, shard_tokens = [], [], 0
+        for text, tokens in zip(input, counts):
+            if shard and (len(shard) >= self.max_request_size or shard_tokens + tokens > self.max_request_tokens):
+                shards.append(shard)
+                shard, shard_tokens = [], 0
+            shard.append(text)
+            shard_tokens += tokens
+        if shard:
+            shards.append(shard)
+        return shards
+
+    async def embed_shard(self, input: List[str], hedge: bool = False) -> List[np.ndarray]:
+        args = {
+            "input": input,
+            "model": self.model_name,
+            # packed float32 vectors are decoded straight into numpy, without per-float python objects
+            "encoding_format": "base64",
+        }
+        # single texts are cheap, so they are retried fast and often
+        time_limit, max_retries = (2, 10) if len(input) == 1 else (self.request_timeout, self.max_retries)
+        # latency sensitive requests are hedged instead of waiting for the whole time limit
+        func = openai.Embedding.acreate
+        if hedge:
+            func = hedged(func, key=f"embeddings:{self.model_name}")
+        async with self.semaphore:
+            embeddings = await UPSTREAMS["openai.embeddings"].call(
+                func, time_limit=time_limit, max_retries=max_retries, **args
+            )
+        return [
+            np.frombuffer(base64.b64decode(embedding_object["embedding"]), dtype="<f4")
+            for embedding_object in embeddings["data"]
+        ]
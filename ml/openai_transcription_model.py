@@ -0,0 +1,129 @@
+import asyncio
+import io
+import itertools
+import os.path as osp
+from collections import deque
+from typing import AsyncIterator, BinaryIO, List, Tuple
+
+import openai
+from loguru import logger
+from pydub import AudioSegment
+from pydub.silence import detect_nonsilent
+
+from utils.retry import UPSTREAMS
+from utils.schemas import SpeechToTextResponse, TranscriptionSegment
+
+
+class OpenAITranscriptionModel:
+    def __init__(
+        self,
+        model_name: str,
+        concurrency: int = 4,
+        time_limit: float = 120,
+        direct_max_bytes: int = 1 << 20,
+        max_segment_ms: int = 120_000,
+        min_silence_ms: int = 500,
+        silence_offset_db: float = 16,
+        bitrate: str = "64k",
+    ):
+        self.model_name = model_name
+        self.time_limit = time_limit
+        self.direct_max_bytes = direct_max_bytes
+        self.max_segment_ms = max_segment_ms
+        self.min_silence_ms = min_silence_ms
+        self.silence_offset_db = silence_offset_db
+        self.bitrate = bitrate
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def transcribe(self, file: BinaryIO, filename: str) -> SpeechToTextResponse:
+        segments = await self.prepare(file, filename)
+        results = await asyncio.gather(*[self.transcribe_segment(buffer, start) for start, buffer in segments])
+        segments = [segment for result in results for segment in result]
+        return SpeechToTextResponse(
+            data=" ".join(segment.text.strip() for segment in segments if segment.text.strip()),
+            segments=segments,
+        )
+
+    async def stream_transcription(self, segments: List[Tuple[int, BinaryIO]]) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Yields ("segment", ...) events of prepared segments in order as soon as they are transcribed.
+        Only `concurrency` segments run ahead of the reader, so a slow client pauses the upstream calls.
+        """
+        segments = iter(segments)
+        window = deque()
+        try:
+            for start, buffer in itertools.islice(segments, self.concurrency):
+                window.append(asyncio.create_task(self.transcribe_segment(buffer, start)))
+            while window:
+                results = await window.popleft()
+                for start, buffer in itertools.islice(segments, 1):
+                    window.append(asyncio.create_task(self.transcribe_segment(buffer, start)))
+                for segment in results:
+                    yield "segment", segment.dict()
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def prepare(self, file: BinaryIO, filename: str) -> List[Tuple[int, BinaryIO]]:
+        """Splits the upload into in-memory segments, so they outlive the request's upload file."""
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        if size <= self.direct_max_bytes:
+            # short recordings are sent as they are, decoding them would take longer than it saves
+            buffer = io.BytesIO(file.read())
+            buffer.name = filename
+            return [(0, buffer)]
+        segments = await asyncio.to_thread(self.split, file, filename)
+        logger.info(f"Transcribing {filename} in {len(segments)} segments")
+        return segments
+
+    async def transcribe_segment(self, buffer: BinaryIO, start_ms: int) -> List[TranscriptionSegment]:
+        async with self.semaphore:
+            transcription = await UPSTREAMS["openai.audio"].call(
+                self.request, buffer, time_limit=self.time_limit, max_retries=3
+            )
+        offset = start_ms / 1000
+        if not transcription.get("segments"):
+            end = offset + float(transcription.get("duration", 0))
+            return [TranscriptionSegment(start=offset, end=end, text=transcription["text"])]
+        return [
+            TranscriptionSegment(start=offset + segment["start"], end=offset + segment["end"], text=segment["text"])
+            for segment in transcription["segments"]
+        ]
+
+    async def request(self, buffer: BinaryIO):
+        # a retried attempt has to upload the segment from its beginning again
+        buffer.seek(0)
+        return await openai.Audio.atranscribe(model=self.model_name, file=buffer, response_format="verbose_json")
+
+    def split(self, file: BinaryIO, filename: str) -> List[Tuple[int, BinaryIO]]:
+        extension = osp.splitext(filename)[1].lstrip(".").lower() or None
+        audio = AudioSegment.from_file(file, format=extension)
+        segments = []
+        for start, end in self.segment_bounds(audio):
+            buffer = io.BytesIO()
+            audio[start:end].export(buffer, format="mp3", bitrate=self.bitrate)
+            buffer.name = f"{osp.splitext(filename)[0]}_{start}.mp3"
+            segments.append((start, buffer))
+        return segments
+
+    def segment_bounds(self, audio: AudioSegment) -> List[Tuple[int, int]]:
+        """Cuts audio in the middle of pauses into segments of at most `max_segment_ms`."""
+        nonsilent = detect_nonsilent(
+            audio,
+            min_silence_len=self.min_silence_ms,
+            silence_thresh=audio.dBFS - self.silence_offset_db,
+            seek_step=10,
+        )
+        cuts = [(end + next_start) // 2 for (_, end), (next_start, _) in zip(nonsilent, nonsilent[1:])]
+        bounds, start = [], 0
+        while len(audio) - start > self.max_segment_ms:
+            candidates = [cut for cut in cuts if start < cut <= start + self.max_segment_ms]
+            # speech without any pause that long is cut hard
+            end = candidates[-1] if candidates else start + self.max_segment_ms
+            bounds.append((start, end))
+            start = end
+        bounds.append((start, len(audio)))
+        return bounds
@@ -0,0 +1,19 @@
+import importlib
+import time
+
+from loguru import logger
+
+# local backends pull in torch and transformers, so they are imported only when the config enables them
+BACKENDS = {
+    "embeddings": "ml.embeddings:EmbeddingModel",
+    "alpaca": "ml.completions.alpaca_completion_model:AlpacaCompletionModel",
+    "t5": "ml.completions.t5_completion_model:T5CompletionModel",
+}
+
+
+def load_backend(name: str) -> type:
+    module_name, class_name = BACKENDS[name].split(":")
+    start = time.perf_counter()
+    backend = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Imported {name} backend in {round(time.perf_counter() - start, 2)} seconds")
+    return backend
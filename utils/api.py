@@ -1,9 +1,15 @@
+import base64
 import traceback
 from functools import wraps
 
-from fastapi import HTTPException, status
+import numpy as np
+from fastapi import HTTPException, Request, status
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from loguru import logger
 
+from utils.retry import CircuitOpenError
+from utils.schemas import EmbeddingsDtype, EmbeddingsEncodingFormat, EmbeddingsFormatInput
+
 
 def catch_errors(func):
     @wraps(func)
@@ -15,9 +21,37 @@ def catch_errors(func):
             traceback.print_exc()
             if isinstance(e, HTTPException):
                 raise e
+            if isinstance(e, CircuitOpenError):
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"{e.__class__.__name__}: {e}",
             )
 
     return wrapper
+
+
+def embeddings_response(embeddings: np.ndarray, embeddings_input: EmbeddingsFormatInput, request: Request) -> Response:
+    # responses are built directly, validating thousands of floats with pydantic is too slow
+    octet_stream = "application/octet-stream" in request.headers.get("accept", "")
+    if not octet_stream and embeddings_input.encoding_format == EmbeddingsEncodingFormat.float:
+        # orjson writes float32 values with their shortest repr instead of the float64 digits of tolist()
+        return ORJSONResponse({"data": embeddings.astype(np.float32)})
+
+    buffer = embeddings.astype("<f2" if embeddings_input.dtype == EmbeddingsDtype.float16 else "<f4").tobytes()
+    if octet_stream:
+        return Response(
+            content=buffer,
+            media_type="application/octet-stream",
+            headers={
+                "X-Embeddings-Shape": ",".join(map(str, embeddings.shape)),
+                "X-Embeddings-Dtype": embeddings_input.dtype.value,
+            },
+        )
+    return JSONResponse(
+        {
+            "data": base64.b64encode(buffer).decode("ascii"),
+            "shape": list(embeddings.shape),
+            "dtype": embeddings_input.dtype.value,
+        }
+    )
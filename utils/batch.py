@@ -0,0 +1,94 @@
+import asyncio
+import json
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Set, Tuple
+
+import openai
+from loguru import logger
+from pydantic import BaseModel
+
+from utils.retry import RetryPolicy
+
+
+async def run_batch(
+    items: Iterable[Tuple[int, BaseModel | Exception]],
+    func: Callable[[BaseModel], Awaitable[BaseModel]],
+    upstream: RetryPolicy,
+    concurrency: int,
+    skip: Set[int] = frozenset(),
+) -> AsyncIterator[str]:
+    """
+    Runs `func` over indexed items with at most `concurrency` of them in flight and yields
+    JSONL results in completion order. The window is halved when the upstream rate limits us
+    and grows back by one on every success; no new items are started while its circuit is open.
+    Items which failed to parse are passed as exceptions and reported right away.
+    """
+    window = concurrency
+    pending: Set[asyncio.Task] = set()
+    items = iter(items)
+    exhausted = False
+    # the next item to start, taken before waiting for the circuit so skipped and invalid items never wait
+    held = None
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                if held is None:
+                    try:
+                        idx, item = held = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if idx in skip:
+                        held = None
+                        continue
+                    if isinstance(item, Exception):
+                        held = None
+                        yield batch_line(idx, error=f"{item.__class__.__name__}: {item}")
+                        continue
+                if upstream.breaker.opened_at is not None:
+                    if pending:
+                        break
+                    logger.warning(f"Batch is waiting for {upstream.name} circuit to close")
+                    await asyncio.sleep(upstream.breaker.reset_timeout)
+                    # a single probe goes through, the window grows back with successes
+                    window = 1
+                (idx, item), held = held, None
+                pending.add(asyncio.create_task(run_item(idx, item, func)))
+            if not pending:
+                continue
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                idx, result, error = task.result()
+                if error is None:
+                    window = min(concurrency, window + 1)
+                    yield batch_line(idx, data=result.dict(exclude_none=True))
+                    continue
+                if isinstance(error, openai.error.RateLimitError):
+                    window = max(1, window // 2)
+                    logger.warning(f"Batch is rate limited, shrinking window to {window}")
+                yield batch_line(idx, error=f"{error.__class__.__name__}: {error}")
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def run_item(idx: int, item: BaseModel, func: Callable[[BaseModel], Awaitable[BaseModel]]):
+    try:
+        return idx, await func(item), None
+    except Exception as e:
+        return idx, None, e
+
+
+def batch_line(idx: int, data: dict | None = None, error: str | None = None) -> str:
+    line = {"index": idx, "data": data} if error is None else {"index": idx, "error": error}
+    return json.dumps(line, ensure_ascii=False) + "\n"
+
+
+def read_jsonl(contents: bytes, model: type[BaseModel]) -> Iterable[Tuple[int, BaseModel | Exception]]:
+    # blank lines are not counted, so indices match the positions of records in the file
+    lines = (line for line in contents.decode("utf-8").splitlines() if line.strip())
+    for idx, line in enumerate(lines):
+        try:
+            yield idx, model.parse_raw(line)
+        except Exception as e:
+            yield idx, e
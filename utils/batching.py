@@ -0,0 +1,68 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent `submit` calls into a single `func(items)` call. A batch is flushed
+    after `max_wait` seconds since its first item or as soon as `max_size` items or `max_tokens`
+    tokens are collected, and every caller receives its own slice of the result.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_wait: float,
+        max_size: int,
+        max_tokens: int | None = None,
+        count_tokens: Callable[[Any], int] | None = None,
+    ):
+        self.func = func
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.items, self.futures, self.tokens = [], [], 0
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, item: Any) -> Any:
+        tokens = self.count_tokens(item) if self.count_tokens else 0
+        if self.max_tokens and self.items and self.tokens + tokens > self.max_tokens:
+            self._flush()
+
+        future = asyncio.get_running_loop().create_future()
+        self.items.append(item)
+        self.futures.append(future)
+        self.tokens += tokens
+
+        if len(self.items) >= self.max_size or (self.max_tokens and self.tokens >= self.max_tokens):
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.items:
+            return
+        items, futures = self.items, self.futures
+        self.items, self.futures, self.tokens = [], [], 0
+        task = asyncio.create_task(self._run(items, futures))
+        # keep a reference so the task is not garbage collected before it is done
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, items: List[Any], futures: List[asyncio.Future]):
+        try:
+            results = await self.func(items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
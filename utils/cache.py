@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import os.path as osp
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Dict, List
+
+import numpy as np
+from loguru import logger
+
+from utils.metrics import CACHE_LOOKUPS
+
+
+def text_key(model: str, text: str) -> str:
+    normalized = unicodedata.normalize("NFC", text).strip()
+    return model + ":" + hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class SqliteCache:
+    """
+    Key-value cache stored in a local sqlite file, so it is shared by all gunicorn workers
+    on the host. Entries are evicted by TTL and, once `max_bytes` is exceeded, in LRU order.
+    Every reading thread has its own connection, which WAL serves next to writers, and reads never
+    write: access times and hit counts are buffered and written every `flush_interval` seconds.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: int, flush_interval: float = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # `lock` serializes the write connection, `pending_lock` only guards the buffers of reads
+        self.lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.accessed: Dict[str, float] = {}
+        self.counts = Counter()
+        self.readers = threading.local()
+        if osp.dirname(path):
+            os.makedirs(osp.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # rows replaced by INSERT OR REPLACE fire the delete trigger only with recursive triggers
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_created ON entries (created)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            # running total of entry sizes, so writes don't sum the whole table
+            self.conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) SELECT 'bytes', COALESCE(SUM(size), 0) FROM entries"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries "
+                "BEGIN UPDATE stats SET value = value + NEW.size WHERE name = 'bytes'; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries "
+                "BEGIN UPDATE stats SET value = value - OLD.size WHERE name = 'bytes'; END"
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        threading.Thread(target=self._flush_periodically, name="cache-flush", daemon=True).start()
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        if not keys:
+            return {}
+        now = time.time()
+        unique = list(dict.fromkeys(keys))
+        found = {}
+        reader = self._reader()
+        # sqlite limits the number of bound parameters per statement
+        for start in range(0, len(unique), 500):
+            chunk = unique[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = reader.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({placeholders}) AND created >= ?",
+                (*chunk, now - self.ttl),
+            ).fetchall()
+            found.update(rows)
+        # every requested key counts, like the cache lookup metrics
+        hits = sum(key in found for key in keys)
+        with self.pending_lock:
+            self.counts["hits"] += hits
+            self.counts["misses"] += len(keys) - hits
+            self.accessed.update((key, now) for key in found)
+        return found
+
+    def set_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+        now = time.time()
+
+        def write():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                [(key, value, len(value), now, now) for key, value in items.items()],
+            )
+            self.conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+            self._evict()
+
+        with self.lock:
+            self._write(write)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            self._write()
+            stats = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "entries": entries,
+            "bytes": stats.get("bytes", 0),
+        }
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self.readers, "conn", None)
+        if conn is None:
+            conn = self.readers.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return conn
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if not self.accessed and not self.counts:
+                continue
+            try:
+                with self.lock:
+                    self._write()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache flush failed with {e.__class__.__name__}: {e}")
+
+    def _write(self, func=None):
+        # buffered reads go first, so eviction sees their access times
+        with self.pending_lock:
+            accessed, counts = self.accessed, self.counts
+            self.accessed, self.counts = {}, Counter()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in accessed.items()],
+            )
+            for name, value in counts.items():
+                self._incr(name, value)
+            if func is not None:
+                func()
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            # kept for the next write, newer reads win
+            with self.pending_lock:
+                self.accessed = {**accessed, **self.accessed}
+                self.counts.update(counts)
+            raise
+
+    def _evict(self):
+        total = self.conn.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop least recently used entries until we are back under the budget
+        excess, evicted = total - self.max_bytes, []
+        cursor = self.conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC")
+        for key, size in cursor:
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        cursor.close()
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def _incr(self, name: str, value: int):
+        self.conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+            (name, value, value),
+        )
+
+
+class MemoryCache:
+    """Per-process counterpart of `SqliteCache` with the same byte budget, TTL and LRU eviction."""
+
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size, self.hits, self.misses = 0, 0, 0
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        now = time.time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] < now - self.ttl:
+                    self._remove(key)
+                    entry = None
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = entry[0]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items: Dict[str, bytes]):
+        now = time.time()
+        with self.lock:
+            for key, value in items.items():
+                if key in self.entries:
+                    self._remove(key)
+                self.entries[key] = (value, now)
+                self.size += len(value)
+            while self.size > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+    def _remove(self, key: str):
+        value, _ = self.entries.pop(key)
+        self.size -= len(value)
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_bytes: int, ttl: int):
+        self.store = SqliteCache(path=path, max_bytes=max_bytes, ttl=ttl)
+
+    def get(self, model: str, texts: List[str]) -> List[np.ndarray | None]:
+        keys = [text_key(model, text) for text in texts]
+        found = self.store.get_many(keys)
+        hits = sum(key in found for key in keys)
+        CACHE_LOOKUPS.labels("embeddings", "hit").inc(hits)
+        CACHE_LOOKUPS.labels("embeddings", "miss").inc(len(keys) - hits)
+        return [np.frombuffer(found[key], dtype="<f4") if key in found else None for key in keys]
+
+    def set(self, model: str, texts: List[str], embeddings: List[np.ndarray]):
+        self.store.set_many(
+            {
+                text_key(model, text): np.asarray(embedding, dtype="<f4").tobytes()
+                for text, embedding in zip(texts, embeddings)
+            }
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return self.store.stats()
+
+
+class CompletionCache:
+    def __init__(self, store: SqliteCache | MemoryCache):
+        self.store = store
+
+    @staticmethod
+    def key(args: dict) -> str:
+        # streamed and non-streamed requests share the same answer
+        request = {name: value for name, value in args.items() if name != "stream"}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, args: dict) -> str | None:
+        key = self.key(args)
+        found = self.store.get_many([key])
+        CACHE_LOOKUPS.labels("completions", "hit" if key in found else "miss").inc()
+        return found[key].decode("utf-8") if key in found else None
+
+    def set(self, args: dict, answer: str):
+        self.store.set_many({self.key(args): answer.encode("utf-8")})
+
+    def stats(self) -> Dict[str, int]:
+        return self.store.stats()
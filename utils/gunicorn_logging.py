@@ -85,6 +85,13 @@ def run_gunicorn_loguru(app, options):
             seen.add(name.split(".")[0])
             logging.getLogger(name).handlers = [intercept_handler]
 
-    logger.configure(handlers=[{"sink": sys.stdout, "serialize": False}])
+    # with enqueue, forked workers only put records on a queue, a thread of the master process writes them
+    enqueue = CONFIG["logging"].getboolean("enqueue")
+    handlers = [{"sink": sys.stdout, "serialize": False, "enqueue": enqueue}]
+    if CONFIG["logging"]["log_path"]:
+        handlers.append(
+            {"sink": CONFIG["logging"]["log_path"], "rotation": CONFIG["logging"]["rotation"], "enqueue": enqueue}
+        )
+    logger.configure(handlers=handlers)
 
     StandaloneApplication(app, options).run()
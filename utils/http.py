@@ -0,0 +1,50 @@
+import aiohttp
+import openai
+from loguru import logger
+
+
+class SharedSession:
+    """Keep-alive aiohttp session of a worker, used by every OpenAI call instead of a session per request."""
+
+    def __init__(self):
+        self.session: aiohttp.ClientSession | None = None
+
+    def open(self, pool_size: int, pool_size_per_host: int, dns_ttl: int, keepalive_timeout: float):
+        # must be called from within the running event loop of the worker
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=pool_size,
+                limit_per_host=pool_size_per_host,
+                ttl_dns_cache=dns_ttl,
+                keepalive_timeout=keepalive_timeout,
+            )
+        )
+        logger.info(f"Opened upstream connection pool of {pool_size} connections")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+UPSTREAM_SESSION = SharedSession()
+
+
+class SharedSessionMiddleware:
+    """
+    Sets `openai.aiosession` for every request. It is a context variable, so it has to be set
+    in the task serving the request; tasks spawned by the request inherit it.
+    """
+
+    def __init__(self, app, shared: SharedSession = UPSTREAM_SESSION):
+        self.app = app
+        self.shared = shared
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or self.shared.session is None:
+            return await self.app(scope, receive, send)
+        token = openai.aiosession.set(self.shared.session)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            openai.aiosession.reset(token)
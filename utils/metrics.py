@@ -0,0 +1,111 @@
+import glob
+import os
+import os.path as osp
+import time
+from typing import List, Tuple
+
+from utils import CONFIG
+
+# every gunicorn worker writes its samples into this directory and /metrics sums them up,
+# it has to be set before prometheus_client is imported
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", CONFIG["metrics"]["multiproc_dir"])
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.routing import Match  # noqa: E402
+
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+REQUEST_LATENCY = Histogram("coreml_request_seconds", "Latency of API requests.", ["endpoint", "api_version", "status"])
+REQUESTS_IN_FLIGHT = Gauge(
+    "coreml_requests_in_flight", "Requests being served.", ["endpoint"], multiprocess_mode="livesum"
+)
+UPSTREAM_LATENCY = Histogram("coreml_upstream_seconds", "Latency of upstream attempts.", ["upstream", "model"])
+UPSTREAM_RETRIES = Counter("coreml_upstream_retries_total", "Retried upstream attempts.", ["upstream", "error"])
+UPSTREAM_FAILURES = Counter(
+    "coreml_upstream_failures_total", "Upstream calls which failed after retries.", ["upstream", "error"]
+)
+TOKENIZATION_LATENCY = Histogram(
+    "coreml_tokenization_seconds",
+    "Time spent on tokenization.",
+    ["operation"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+)
+PROMPT_TOKENS = Histogram("coreml_prompt_tokens", "Tokens sent in prompts.", ["model"], buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram(
+    "coreml_completion_tokens", "Tokens of generated answers.", ["model"], buckets=TOKEN_BUCKETS
+)
+CACHE_LOOKUPS = Counter("coreml_cache_lookups_total", "Cache lookups by result.", ["cache", "result"])
+ANSWER_FILTER_DECISIONS = Counter(
+    "coreml_answer_filter_decisions_total", "Answer in context calls by deciding tier and answer.", ["tier", "answer"]
+)
+
+
+def reset_metrics(server=None):
+    """Gunicorn on_starting hook: samples of a previous run would be summed into the new one."""
+    for path in glob.glob(osp.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+
+
+def mark_worker_dead(server, worker):
+    """Gunicorn child_exit hook: drops live gauges of the exited worker."""
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def sample_values(name: str) -> List[Tuple[dict, float]]:
+    """Labels and values of a metric summed over all workers, as /metrics reports them."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return [
+        (sample.labels, sample.value)
+        for metric in registry.collect()
+        for sample in metric.samples
+        if sample.name == name
+    ]
+
+
+def metrics_response() -> tuple:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """Records latency and in-flight requests per route template, including the ones failing in handlers."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        endpoint, api_version = "unmatched", ""
+        for route in scope["app"].routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                endpoint = route.path
+                api_version = child_scope.get("path_params", {}).get("api_version", "")
+                break
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(endpoint).inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+            REQUEST_LATENCY.labels(endpoint, api_version, status).observe(time.perf_counter() - start)
@@ -1,18 +1,122 @@
 import asyncio
 import time
+from collections import defaultdict, deque
+from functools import wraps
+from typing import Dict, Tuple
 
 from loguru import logger
 
+from utils import CONFIG
 
-async def retry_with_time_limit(func, time_limit=20, max_retries=3, *args, **kwargs):
-    retries = 0
-    while retries < max_retries:
+
+class LatencyTracker:
+    """
+    Keeps recent latencies per key. `limits` holds the default, min and max delay of an endpoint,
+    the part of the key before ":", with "" as the fallback. At most `budget` of the requests
+    of a key are hedged, the tokens for it are earned by requests and spent by hedges.
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        window: int,
+        min_samples: int,
+        budget: float,
+        limits: Dict[str, Tuple[float, float, float]],
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.max_tokens = max(1.0, budget * window)
+        self.limits = limits
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.tokens = defaultdict(float)
+
+    def observe(self, key: str, latency: float):
+        self.latencies[key].append(latency)
+
+    def delay(self, key: str) -> float:
+        default, min_delay, max_delay = self.limits.get(key.split(":")[0], self.limits[""])
+        latencies = self.latencies[key]
+        if len(latencies) < self.min_samples:
+            return default
+        latencies = sorted(latencies)
+        delay = latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+        return min(max(delay, min_delay), max_delay)
+
+    def track(self, key: str):
+        self.tokens[key] = min(self.tokens[key] + self.budget, self.max_tokens)
+
+    def take_hedge(self, key: str) -> bool:
+        if self.tokens[key] < 1:
+            return False
+        self.tokens[key] -= 1
+        return True
+
+
+def hedging_limits() -> Dict[str, Tuple[float, float, float]]:
+    limits = {}
+    for section in [section for section in CONFIG.sections() if section.startswith("hedging.")] + ["hedging"]:
+        limits[section.partition(".")[2]] = (
+            int(CONFIG[section]["default_delay_ms"]) / 1000,
+            int(CONFIG[section]["min_delay_ms"]) / 1000,
+            int(CONFIG[section]["max_delay_ms"]) / 1000,
+        )
+    return limits
+
+
+HEDGING_LATENCIES = LatencyTracker(
+    percentile=float(CONFIG["hedging"]["percentile"]),
+    window=int(CONFIG["hedging"]["window"]),
+    min_samples=int(CONFIG["hedging"]["min_samples"]),
+    budget=float(CONFIG["hedging"]["budget_percent"]) / 100,
+    limits=hedging_limits(),
+)
+
+
+def hedged(func, key: str):
+    """
+    Wraps an upstream call so that, if it has not answered within the recent latency percentile
+    for `key`, an identical request is fired in parallel while the hedge budget allows it.
+    The first answer wins, the other is cancelled.
+    """
+    if not CONFIG["hedging"].getboolean("enabled"):
+        return func
+
+    async def attempt(*args, **kwargs):
+        start = time.time()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # a cancelled attempt took at least this long; only the ones which outlived the delay are kept,
+            # otherwise slow attempts which lost to their hedge would never raise the percentile
+            elapsed = time.time() - start
+            if elapsed >= HEDGING_LATENCIES.delay(key):
+                HEDGING_LATENCIES.observe(key, elapsed)
+            raise
+        HEDGING_LATENCIES.observe(key, time.time() - start)
+        return result
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        HEDGING_LATENCIES.track(key)
+        first = asyncio.create_task(attempt(*args, **kwargs))
+        tasks = {first}
         try:
-            result = await asyncio.wait_for(func(*args, **kwargs), timeout=time_limit)
-            return result
-        except asyncio.TimeoutError:
-            retries += 1
-            logger.warning(f"Retry #{retries} out of {max_retries}")
-
-    logger.error("Max retries reached, returning None")
-    return None
+            delay = HEDGING_LATENCIES.delay(key)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and HEDGING_LATENCIES.take_hedge(key):
+                logger.info(f"Hedging {key} request after {round(delay, 3)} seconds")
+                tasks.add(asyncio.create_task(attempt(*args, **kwargs)))
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception():
+                        return task.result()
+            return first.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return wrapper
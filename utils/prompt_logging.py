@@ -0,0 +1,28 @@
+import random
+
+from loguru import logger
+
+from utils import CONFIG
+
+
+class PromptLogger:
+    """Logs rendered prompts and answers for a sampled share of requests, cut to `max_chars`."""
+
+    def __init__(self, sample_rate: float, max_chars: int):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+
+    def sample(self) -> bool:
+        # decided once per request, so a logged prompt always comes with its answer
+        return random.random() < self.sample_rate
+
+    def log(self, title: str, body: str):
+        if self.max_chars and len(body) > self.max_chars:
+            body = body[: self.max_chars] + f"... [{len(body) - self.max_chars} more characters]"
+        logger.info(title + "\n" + body)
+
+
+PROMPT_LOG = PromptLogger(
+    sample_rate=float(CONFIG["logging"]["prompt_sample_rate"]),
+    max_chars=int(CONFIG["logging"]["prompt_max_chars"]),
+)
@@ -0,0 +1,144 @@
+import asyncio
+import random
+import time
+
+import openai
+from loguru import logger
+
+from utils import CONFIG
+from utils.metrics import UPSTREAM_FAILURES, UPSTREAM_LATENCY, UPSTREAM_RETRIES
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # half-open: let one probe request through every `reset_timeout` seconds
+        if time.time() - self.opened_at >= self.reset_timeout:
+            self.opened_at = time.time()
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} is closed again")
+        self.failures, self.opened_at = 0, None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(f"Circuit for {self.name} is open after {self.failures} consecutive failures")
+            self.opened_at = time.time()
+
+
+class RetryPolicy:
+    """
+    Calls an upstream with a per-attempt time limit, exponential backoff with full jitter,
+    `Retry-After` honoring, a concurrency limit and a circuit breaker shared by all its callers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_retries: int,
+        time_limit: float,
+        base_delay: float,
+        max_delay: float,
+        concurrency: int,
+        failure_threshold: int,
+        reset_timeout: float,
+    ):
+        self.name = name
+        self.max_retries = max_retries
+        self.time_limit = time_limit
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+    async def call(self, func, *args, time_limit: float | None = None, max_retries: int | None = None, **kwargs):
+        time_limit = time_limit or self.time_limit
+        max_retries = max_retries or self.max_retries
+        model = kwargs.get("model", "")
+        for attempt in range(1, max_retries + 1):
+            if not self.breaker.allow():
+                UPSTREAM_FAILURES.labels(self.name, CircuitOpenError.__name__).inc()
+                raise CircuitOpenError(f"Upstream {self.name} is unavailable, retry later")
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()
+                    try:
+                        result = await asyncio.wait_for(func(*args, **kwargs), timeout=time_limit)
+                    finally:
+                        UPSTREAM_LATENCY.labels(self.name, model).observe(time.perf_counter() - start)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    UPSTREAM_FAILURES.labels(self.name, e.__class__.__name__).inc()
+                    raise
+                self.breaker.record_failure()
+                if attempt == max_retries:
+                    logger.error(f"{self.name}: max retries reached")
+                    UPSTREAM_FAILURES.labels(self.name, e.__class__.__name__).inc()
+                    raise
+                UPSTREAM_RETRIES.labels(self.name, e.__class__.__name__).inc()
+                delay = self.backoff(attempt, e)
+                logger.warning(
+                    f"{self.name}: {e.__class__.__name__} on attempt #{attempt} out of {max_retries}, "
+                    f"retrying in {round(delay, 2)} seconds"
+                )
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        headers = getattr(error, "headers", None) or {}
+        try:
+            return max(delay, float(headers.get("retry-after", 0)))
+        except ValueError:
+            return delay
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        if isinstance(error, RETRYABLE_ERRORS):
+            return True
+        if isinstance(error, openai.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+        return False
+
+
+UPSTREAMS = {
+    name: RetryPolicy(
+        name=name,
+        max_retries=int(CONFIG["retry"]["max_retries"]),
+        time_limit=float(CONFIG["retry"]["time_limit"]),
+        base_delay=int(CONFIG["retry"]["base_delay_ms"]) / 1000,
+        max_delay=int(CONFIG["retry"]["max_delay_ms"]) / 1000,
+        concurrency=int(CONFIG["retry"]["concurrency"]),
+        failure_threshold=int(CONFIG["retry"]["failure_threshold"]),
+        reset_timeout=float(CONFIG["retry"]["reset_timeout"]),
+    )
+    for name in ("openai.embeddings", "openai.completions", "openai.audio")
+}
@@ -14,20 +14,57 @@ class AnswerInContextResponse(BaseModel):
         description="Whether the answer is in context.",
         example=True,
     )
+    confidence: float | None = Field(
+        default=None,
+        description="Confidence of the scorer from 0 to 1 that the answer is in context. Empty when the answer was decided by the local pre-filter, which is skipped when a threshold is given.",
+        example=0.87,
+    )
+
+
+class AnswerFilterStatsResponse(BaseModel):
+    lexical_true: int = Field(description="Calls answered positively by term overlap.", example=120)
+    lexical_false: int = Field(description="Calls answered negatively for lack of any context.", example=300)
+    embeddings_true: int = Field(description="Calls answered positively by embeddings similarity.", example=80)
+    embeddings_false: int = Field(description="Calls answered negatively by embeddings similarity.", example=150)
+    escalated: int = Field(description="Calls left to the LLM scorer.", example=50)
+    short_circuited: float = Field(description="Share of calls decided without the LLM scorer.", example=0.93)
 
 
 class HTTPExceptionResponse(BaseModel):
     detail: str = Field(example="Internal Server Error")
 
 
-class EmbeddingsInput(BaseModel):
+class EmbeddingsEncodingFormat(str, Enum):
+    float = "float"
+    base64 = "base64"
+
+
+class EmbeddingsDtype(str, Enum):
+    float32 = "float32"
+    float16 = "float16"
+
+
+class EmbeddingsFormatInput(BaseModel):
+    encoding_format: EmbeddingsEncodingFormat = Field(
+        default=EmbeddingsEncodingFormat.float,
+        description="Format of returned embeddings: list of floats or base64 of a packed little-endian buffer. Sending `Accept: application/octet-stream` returns the raw buffer instead.",
+        example=EmbeddingsEncodingFormat.float,
+    )
+    dtype: EmbeddingsDtype = Field(
+        default=EmbeddingsDtype.float32,
+        description="Type of packed values when embeddings are returned as a buffer.",
+        example=EmbeddingsDtype.float32,
+    )
+
+
+class EmbeddingsInput(EmbeddingsFormatInput):
     input: List[str] = Field(description="Texts to embed.", example=["Hello world!"])
 
     def __hash__(self):
         return hash(tuple(self.input))
 
 
-class EmbeddingsInputInstruction(BaseModel):
+class EmbeddingsInputInstruction(EmbeddingsFormatInput):
     input: List[str] = Field(description="Texts to embed.", example=["Hello world!"])
     instruction: str | None = Field(
         description="Instruction to for embeddings model.",
@@ -42,6 +79,22 @@ class EmbeddingsResponse(BaseModel):
     )
 
 
+class EmbeddingsBase64Response(BaseModel):
+    data: str = Field(
+        description="Base64 of embeddings packed row by row into a little-endian buffer.",
+        example="zczMPc3MTD6amZk+",
+    )
+    shape: List[int] = Field(description="Number of embeddings and their dimension.", example=[1, 3])
+    dtype: EmbeddingsDtype = Field(description="Type of packed values.", example=EmbeddingsDtype.float32)
+
+
+class CacheStatsResponse(BaseModel):
+    hits: int = Field(description="Number of lookups served from cache.", example=42)
+    misses: int = Field(description="Number of lookups not found in cache.", example=7)
+    entries: int = Field(description="Number of entries currently stored.", example=35)
+    bytes: int = Field(description="Size of stored entries in bytes.", example=215040)
+
+
 class CompletionsMode(str, Enum):
     general = "general"
     support = "support"
@@ -62,6 +115,11 @@ class SummarizationInput(BaseModel):
         description="If true, the response will be streamed as it is generated. This is useful for long-running requests.",
         example=False,
     )
+    progress: bool = Field(
+        default=False,
+        description="If true together with stream, long texts stream summaries of their parts and progress events as server-sent events before the final summary.",
+        example=False,
+    )
 
 
 class Role(str, Enum):
@@ -110,12 +168,69 @@ class CompletionsInput(BaseModel):
         return hash((self.query, self.info, chat_hashable, self.mode))
 
 
+class TokenUsage(BaseModel):
+    prompt_tokens: int = Field(description="Number of tokens in the prompt sent to the model.", example=1200)
+    completion_tokens: int | None = Field(
+        default=None, description="Number of tokens in the generated answer.", example=85
+    )
+    trimmed_messages: int = Field(
+        default=0, description="Number of oldest chat messages dropped to fit the context window.", example=0
+    )
+    truncated_info_tokens: int = Field(
+        default=0, description="Number of tokens cut from the end of info to fit the context window.", example=0
+    )
+
+
 class CompletionsResponse(BaseModel):
     data: str = Field(
         description="Response to the given info and query.",
         example="I used to play drums.",
     )
+    usage: TokenUsage | None = Field(default=None, description="Token accounting of the request.")
+
+
+class BatchTask(str, Enum):
+    completions = "completions"
+    if_answer_in_context = "if_answer_in_context"
+
+
+class CompletionsBatchInput(BaseModel):
+    task: BatchTask = Field(
+        default=BatchTask.completions,
+        description="Endpoint to run every input through.",
+        example=BatchTask.completions,
+    )
+    inputs: List[CompletionsInput] = Field(description="Inputs to process. Streaming is ignored.")
+    threshold: float | None = Field(
+        default=None,
+        ge=0,
+        le=1,
+        description="Minimal confidence to consider the answer in context for the if_answer_in_context task. Inputs with a threshold skip the local pre-filter.",
+        example=0.5,
+    )
+    skip: List[int] = Field(
+        default=[],
+        description="Indices of inputs which already succeeded, used to resume a partially failed batch.",
+        example=[],
+    )
+
+
+class CompletionsBatchResult(BaseModel):
+    index: int = Field(description="Index of the input in the batch.", example=0)
+    data: CompletionsResponse | AnswerInContextResponse | None = Field(
+        default=None, description="Result of the input if it succeeded."
+    )
+    error: str | None = Field(default=None, description="Error of the input if it failed.")
+
+
+class TranscriptionSegment(BaseModel):
+    start: float = Field(description="Start of the segment in seconds.", example=0.0)
+    end: float = Field(description="End of the segment in seconds.", example=4.2)
+    text: str = Field(description="Transcribed text of the segment.", example="Hello, how can I help you?")
 
 
 class SpeechToTextResponse(BaseModel):
     data: str = Field(description="Transcribed text")
+    segments: List[TranscriptionSegment] | None = Field(
+        default=None, description="Transcribed segments with their timestamps in the recording."
+    )
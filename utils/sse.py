@@ -0,0 +1,110 @@
+import asyncio
+import json
+from typing import AsyncIterator, Dict, Tuple
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from loguru import logger
+
+from utils import CONFIG
+
+HEARTBEAT = ": keep-alive\n\n"
+END_OF_STREAM = object()
+
+
+def sse_event(data: str, event: str | None = None) -> str:
+    frame = f"event: {event}\n" if event else ""
+    return frame + "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
+
+
+def sse_data(text: str) -> str:
+    # json.dumps escapes newlines, so a delta always fits into a single `data:` line
+    return f"data: {json.dumps({'data': text}, ensure_ascii=False)}\n\n"
+
+
+async def stream_sse(
+    request: Request | None,
+    deltas: AsyncIterator[str | Tuple[str, dict]],
+    coalesce: float,
+    heartbeat: float,
+    max_pending: int = 0,
+) -> AsyncIterator[str]:
+    """
+    Frames text deltas as server-sent events, merging the deltas which arrive within `coalesce`
+    seconds into one frame. `(event, payload)` items are sent as named events right away. A comment
+    is sent after `heartbeat` seconds of silence, and the upstream is cancelled once the client is gone.
+    """
+    loop = asyncio.get_running_loop()
+    # a slow client fills the queue and pauses reading the upstream instead of buffering it all
+    queue = asyncio.Queue(maxsize=max_pending)
+
+    async def read():
+        try:
+            async for delta in deltas:
+                if delta:
+                    await queue.put(delta)
+        except Exception:
+            await queue.put(END_OF_STREAM)
+            raise
+        await queue.put(END_OF_STREAM)
+
+    reader = asyncio.create_task(read())
+    try:
+        finished = False
+        while not finished:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                if request is not None and await request.is_disconnected():
+                    logger.info("Client disconnected, cancelling upstream stream")
+                    return
+                yield HEARTBEAT
+                continue
+
+            buffer, events = [], []
+            deadline = loop.time() + coalesce
+            while True:
+                if item is END_OF_STREAM:
+                    finished = True
+                    break
+                if isinstance(item, tuple):
+                    events.append(item)
+                    break
+                buffer.append(item)
+                if loop.time() >= deadline:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            if buffer:
+                yield sse_data("".join(buffer))
+            for event, payload in events:
+                yield sse_event(json.dumps(payload, ensure_ascii=False), event=event)
+
+        await asyncio.wait([reader])
+        if reader.exception():
+            error = reader.exception()
+            logger.error(f"Stream failed with {error.__class__.__name__}: {error}")
+            yield sse_event(json.dumps({"detail": f"{error.__class__.__name__}: {error}"}), event="error")
+        else:
+            yield sse_event("{}", event="done")
+    finally:
+        # closing the upstream iterator releases the connection, so no more tokens are paid for
+        reader.cancel()
+
+
+def sse_response(
+    request: Request | None, deltas: AsyncIterator[str | Tuple[str, dict]], headers: Dict[str, str] | None = None
+) -> StreamingResponse:
+    return StreamingResponse(
+        stream_sse(
+            request,
+            deltas,
+            coalesce=int(CONFIG["streaming"]["coalesce_ms"]) / 1000,
+            heartbeat=float(CONFIG["streaming"]["heartbeat_s"]),
+            max_pending=int(CONFIG["streaming"]["max_pending"]),
+        ),
+        media_type='text/event-stream',
+        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache', **(headers or {})},
+    )
@@ -0,0 +1,31 @@
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "InstructorEmbedding")
+
+
+class StartupReport:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.steps.append((name, time.perf_counter() - start))
+
+    def log(self):
+        # ru_maxrss is in kilobytes on linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        heavy = [module for module in HEAVY_MODULES if module in sys.modules]
+        logger.info(
+            f"Worker {os.getpid()} started in {round(time.perf_counter() - self.started, 2)} seconds "
+            f"({', '.join(f'{name} {round(seconds, 2)}s' for name, seconds in self.steps)}), "
+            f"peak RSS {rss} MB, heavy modules loaded: {', '.join(heavy) or 'none'}"
+        )
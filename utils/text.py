@@ -0,0 +1,51 @@
+import re
+from typing import List, Tuple
+
+import tiktoken
+
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_units(enc: tiktoken.Encoding, text: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """Splits text into paragraphs, falling back to sentences and raw token windows for long ones."""
+    # every unit is counted with one extra token for the separator it is joined with
+    units = []
+    for paragraph in PARAGRAPH_RE.split(text):
+        if not paragraph.strip():
+            continue
+        tokens = enc.encode(paragraph)
+        if len(tokens) <= max_tokens:
+            units.append((paragraph, len(tokens) + 1))
+            continue
+        for sentence in SENTENCE_RE.split(paragraph):
+            tokens = enc.encode(sentence)
+            for start in range(0, len(tokens), max_tokens):
+                window = tokens[start : start + max_tokens]
+                units.append((enc.decode(window) if len(tokens) > max_tokens else sentence, len(window) + 1))
+    return units
+
+
+def pack_units(units: List[Tuple[str, int]], max_tokens: int, overlap_tokens: int = 0, sep: str = "\n\n") -> List[str]:
+    """Greedily packs units into chunks of at most `max_tokens`, repeating up to `overlap_tokens` between chunks."""
+    chunks, chunk, chunk_tokens = [], [], 0
+    for unit, tokens in units:
+        if chunk and chunk_tokens + tokens > max_tokens:
+            chunks.append(sep.join(text for text, _ in chunk))
+            # carry the tail of the previous chunk over, so no idea is cut in half
+            overlap, overlap_size = [], 0
+            for text, size in reversed(chunk):
+                if overlap_size + size > overlap_tokens or overlap_size + size + tokens > max_tokens:
+                    break
+                overlap.insert(0, (text, size))
+                overlap_size += size
+            chunk, chunk_tokens = overlap, overlap_size
+        chunk.append((unit, tokens))
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(sep.join(text for text, _ in chunk))
+    return chunks
+
+
+def split_text(enc: tiktoken.Encoding, text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    return pack_units(split_units(enc, text, max_tokens), max_tokens, overlap_tokens)
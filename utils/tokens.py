@@ -0,0 +1,38 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List
+
+import tiktoken
+
+
+class TokenCounter:
+    """Counts tokens of text segments, remembering counts of recently seen segments."""
+
+    def __init__(self, enc: tiktoken.Encoding, max_entries: int = 8192):
+        self.enc = enc
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.counts = OrderedDict()
+
+    def count(self, text: str) -> int:
+        # hashing is much cheaper than encoding, so repeated `info` contexts are counted once
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+        count = len(self.enc.encode(text))
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.max_entries:
+                self.counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages: List[dict]) -> int:
+        # every message costs a few extra tokens for its role and delimiters, the reply is primed with 3 more
+        return sum(self.count(message["content"]) + 4 for message in messages) + 3
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.enc.encode(text)
+        return text if len(tokens) <= max_tokens else self.enc.decode(tokens[:max_tokens])